@@ -0,0 +1,185 @@
+import argparse
+import time
+from datetime import datetime
+
+import pyarrow as pa
+
+from category_cache import CategoryCache
+from doc_builder import build_offer_documents, build_product_documents
+from parquet_stream import iter_record_batches
+
+
+def iterrows(batch):
+    """Строки батча так же, как их отдавал прежний df.iterrows()"""
+    return (row for _, row in batch.to_pandas().iterrows())
+
+
+def pylist_rows(batch):
+    """Строки батча как словари (потоковый цикл без pandas)"""
+    return batch.to_pylist()
+
+
+def build_product_documents_rowwise(rows):
+    """Построчная сборка документов products (прежний цикл create_products.py)"""
+    documents = []
+    for row in rows:
+        partner = str(row['Partner_Name'])
+        offer_id = str(row['Offer_ID'])
+        doc_id = f"{partner}_{offer_id}"
+
+        category_path = str(row['Category_FullPathName'])
+        normalized_path = category_path.replace('\\', '/')
+        path_parts = [part.strip() for part in normalized_path.split('/') if part.strip()]
+
+        if not path_parts:
+            continue
+
+        breadcrumbs = []
+        for i, part in enumerate(path_parts, 1):
+            breadcrumbs.append({
+                "level": i,
+                "name": part
+            })
+
+        documents.append({
+            "_id": doc_id,
+            "partner": partner,
+            "offer_id": offer_id,
+            "name": str(row['Offer_Name']),
+            "type": str(row['Offer_Type']),
+            "category": {
+                "id": str(row['Category_ID']),
+                "name": path_parts[-1],
+                "full_path": normalized_path,
+                "breadcrumbs": breadcrumbs
+            },
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        })
+    return documents
+
+
+def build_offer_documents_rowwise(rows):
+    """Построчная сборка документов offers (прежний цикл main.py)"""
+    documents = []
+    for row in rows:
+        category_path = str(row['Category_FullPathName'])
+        documents.append({
+            "_id": str(row['Offer_ID']),
+            "offer_id": str(row['Offer_ID']),
+            "name": str(row['Offer_Name']),
+            "offer_type": str(row['Offer_Type']),
+            "partner": str(row['Partner_Name']),
+            "category": {
+                "id": str(row['Category_ID']),
+                "path": category_path,
+                "level": len(category_path.split('\\')) if category_path else 1,
+                "parts": category_path.split('\\')
+            },
+            "created_at": datetime.utcnow(),
+            "updated_at": datetime.utcnow()
+        })
+    return documents
+
+
+def synthetic_batches(rows, batch_size):
+    """Синтетический снапшот, похожий на Ozon: ~5k категорий глубиной до 8 уровней"""
+    paths = []
+    for i in range(5261):
+        depth = 1 + i % 8
+        paths.append('\\'.join(f"Раздел {i // (9 ** level) % 9} ур.{level + 1}" for level in range(depth)))
+
+    for start in range(0, rows, batch_size):
+        n = min(batch_size, rows - start)
+        ids = range(start, start + n)
+        yield pa.record_batch({
+            'Partner_Name': ['_ozon'] * n,
+            'Offer_ID': [str(1600000000 + i) for i in ids],
+            'Offer_Name': [f"Товар номер {i}" for i in ids],
+            'Offer_Type': [f"Тип {i % 12379}" for i in ids],
+            'Category_ID': [str(10000 + i % 5261) for i in ids],
+            'Category_FullPathName': [paths[i % 5261] for i in ids],
+        })
+
+
+def strip_timestamps(documents):
+    """Документы без меток времени и вычисляемых полей (source_hash, category.ancestor_ids)"""
+    stripped = []
+    for doc in documents:
+        doc = {k: v for k, v in doc.items() if k not in ("created_at", "updated_at", "source_hash")}
+        doc["category"] = {k: v for k, v in doc["category"].items() if k != "ancestor_ids"}
+        stripped.append(doc)
+    return stripped
+
+
+def timed(build, batches):
+    """Сборка документов по всем батчам с замером времени"""
+    start = time.perf_counter()
+    documents = [doc for batch in batches for doc in build(batch)]
+    return documents, time.perf_counter() - start
+
+
+def run_benchmark(batches, rowwise, vectorized, label):
+    """Замер строк/сек: iterrows, построчно по словарям и колоночно"""
+    rows = sum(batch.num_rows for batch in batches)
+
+    # Прогрев вычислительных ядер Arrow, чтобы не мерить инициализацию
+    vectorized(batches[0].slice(0, 10), cache=CategoryCache())
+
+    # Свой пустой кэш категорий: в замер входит и построение поддокументов
+    cache = CategoryCache()
+    variants = [
+        ("df.iterrows() (исходный цикл)", lambda batch: rowwise(iterrows(batch))),
+        ("RecordBatch.to_pylist()", lambda batch: rowwise(pylist_rows(batch))),
+        ("Колоночно (Arrow) + кэш категорий", lambda batch: vectorized(batch, cache=cache)),
+    ]
+
+    print(f"\n  {label}:")
+    results = []
+    for name, build in variants:
+        documents, elapsed = timed(build, batches)
+        results.append((documents, elapsed))
+        print(f"    {name:<36} {rows / elapsed:>12,.0f} строк/сек ({elapsed:.2f} с)")
+
+    baseline_time = results[0][1]
+    vectorized_docs, vectorized_time = results[-1]
+    same = all(strip_timestamps(documents) == strip_timestamps(vectorized_docs)
+               for documents, _ in results[:-1])
+
+    print(f"    Ускорение относительно iterrows: x{baseline_time / vectorized_time:.1f}")
+    print(f"    Кэш категорий: построено {cache.misses:,}, повторно {cache.hits:,}")
+    print(f"    Документы совпадают: {'да' if same else 'НЕТ'}")
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сборки документов: построчно против колоночно")
+    parser.add_argument("parquet_file", nargs="?", help="Parquet снапшот (по умолчанию синтетические данные)")
+    parser.add_argument("--rows", type=int, default=200000, help="Строк синтетических данных")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print("БЕНЧМАРК СБОРКИ ДОКУМЕНТОВ")
+    print("=" * 70)
+
+    if args.parquet_file:
+        batches = []
+        for _, batch in iter_record_batches(args.parquet_file, batch_size=args.batch_size):
+            batches.append(batch)
+            if sum(b.num_rows for b in batches) >= args.rows:
+                break
+    else:
+        batches = list(synthetic_batches(args.rows, args.batch_size))
+
+    print(f"Строк: {sum(batch.num_rows for batch in batches):,}, батчей: {len(batches)}")
+
+    ok = run_benchmark(batches, build_product_documents_rowwise, build_product_documents, "products")
+    ok &= run_benchmark(batches, build_offer_documents_rowwise, build_offer_documents, "offers")
+
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+
+def build_and_encode(build, batch, derive=None):
+    """Сборка документов батча и кодирование в BSON (выполняется в процессе пула)"""
+    documents = build(batch)
+    derived = derive(documents) if derive is not None else None
+    return [bson.encode(document) for document in documents], derived
+
+
+class EncoderStage:
+    """
+    Стадия между сборкой документов и записью.
+
+    processes=0 - документы строятся в текущем процессе и кодируются в BSON
+    самим pymongo при вставке (как раньше). processes>0 - батчи Arrow
+    уходят в пул процессов, где строятся документы и кодируются в BSON;
+    основной процесс получает готовые байты и оборачивает их в
+    RawBSONDocument, которые pymongo отправляет в сокет без повторного
+    кодирования. В работе одновременно не больше max_in_flight батчей,
+    порядок батчей сохраняется.
+
+    derive(документы) - то, что основной процесс иначе вычислял бы по
+    документам (счетчики, скетчи, строки autocomplete): считается там же,
+    где строятся документы, пока они еще dict, и RawBSONDocument
+    не приходится декодировать обратно.
+    """
+
+    def __init__(self, build, processes=0, max_in_flight=None, derive=None):
+        self.build = build
+        self.derive = derive
+        self.processes = processes
+        self.max_in_flight = max_in_flight or processes * 2
+        self.executor = ProcessPoolExecutor(max_workers=processes) if processes > 0 else None
+
+    @property
+    def mode(self):
+        return f"{self.processes} процессов" if self.executor else "в основном процессе"
+
+    def imap(self, batches):
+        """
+        Обработка потока (row group, RecordBatch).
+
+        Возвращает четверки (row group, документы, результат derive, ошибка);
+        при ошибке список документов пустой.
+        """
+        if self.executor is None:
+            for rg_index, batch in batches:
+                try:
+                    documents = self.build(batch)
+                    yield rg_index, documents, self.derive(documents) if self.derive else None, None
+                except Exception as e:
+                    yield rg_index, [], None, e
+            return
+
+        in_flight = deque()
+        for rg_index, batch in batches:
+            in_flight.append((rg_index, self.executor.submit(build_and_encode, self.build, batch, self.derive)))
+            if len(in_flight) >= self.max_in_flight:
+                yield self._result(*in_flight.popleft())
+
+        while in_flight:
+            yield self._result(*in_flight.popleft())
+
+    @staticmethod
+    def _result(rg_index, future):
+        try:
+            encoded, derived = future.result()
+            return rg_index, [RawBSONDocument(raw) for raw in encoded], derived, None
+        except Exception as e:
+            return rg_index, [], None, e
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,193 @@
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from bson import json_util
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure
+
+# Коды ошибок сервера, после которых запись имеет смысл повторить
+# (смена primary, сетевые сбои, конфликты записи)
+TRANSIENT_CODES = {
+    6,      # HostUnreachable
+    7,      # HostNotFound
+    89,     # NetworkTimeout
+    91,     # ShutdownInProgress
+    112,    # WriteConflict
+    189,    # PrimarySteppedDown
+    262,    # ExceededTimeLimit
+    9001,   # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    13436,  # NotPrimaryOrSecondary
+}
+
+DUPLICATE_KEY = 11000
+
+
+def is_transient(error):
+    """Временная ли ошибка записи (элемент writeErrors или исключение pymongo)"""
+    if isinstance(error, ConnectionFailure):
+        return True
+    if isinstance(error, OperationFailure):
+        return error.code in TRANSIENT_CODES or error.has_error_label("RetryableWriteError")
+    return error.get("code") in TRANSIENT_CODES or "RetryableWriteError" in error.get("errorLabels", [])
+
+
+class BulkWriter:
+    """
+    Пакетная запись с разбором BulkWriteError, повторами и dead-letter файлом.
+
+    Батч отправляется одной командой (ordered=False). При BulkWriteError
+    по writeErrors определяются упавшие позиции: повторяются только они
+    и только при временных ошибках (сеть, NotWritablePrimary, WriteConflict),
+    с экспоненциальной задержкой. Постоянные ошибки (дубликат ключа,
+    валидация) пишутся в JSONL dead-letter файл и учитываются в счетчиках.
+    Сетевое исключение без деталей повторяет весь остаток батча; дубликаты
+    на повторе считаются записанными предыдущей попыткой. Неидемпотентные
+    операции (idempotent=False, например $inc счетчиков) так не повторяются:
+    часть батча могла примениться, и повтор учел бы ее дважды - остаток
+    уходит в dead-letter, а счетчики пересчитываются отдельно. Одна плохая
+    строка больше не превращает батч в 10 000 отдельных insert_one.
+
+    Объект потокобезопасен и используется всеми потоками WriterPool.
+    """
+
+    def __init__(self, collection, dead_letter_path=None, max_retries=5,
+                 backoff_base=0.5, backoff_max=30.0, ignore_duplicates=False, idempotent=True):
+        self.collection = collection
+        self.dead_letter_path = Path(dead_letter_path) if dead_letter_path else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # При дозагрузке дубликаты _id ожидаемы и не считаются ошибкой
+        self.ignore_duplicates = ignore_duplicates
+        # Можно ли повторить операцию, не зная, применилась ли она
+        self.idempotent = idempotent
+
+        self.lock = threading.Lock()
+        self.written = 0
+        self.retried = 0
+        self.duplicates = 0
+        self.dead_lettered = 0
+        self.errors_by_code = {}
+
+    def insert(self, documents):
+        """insert_many(ordered=False) с разбором ошибок; возвращает число вставленных"""
+        written = self._execute(list(documents),
+                                lambda items: self.collection.insert_many(items, ordered=False),
+                                lambda result: len(result.inserted_ids))
+        self._count(written=written)
+        return written
+
+    def write(self, operations):
+        """bulk_write(ordered=False) с разбором ошибок; возвращает число затронутых документов"""
+        written = self._execute(list(operations),
+                                lambda items: self.collection.bulk_write(items, ordered=False),
+                                lambda result: self._affected(result.bulk_api_result))
+        self._count(written=written)
+        return written
+
+    @staticmethod
+    def _affected(details):
+        return (details.get("nInserted", 0) + details.get("nUpserted", 0)
+                + details.get("nModified", 0) + details.get("nRemoved", 0))
+
+    def _execute(self, pending, send, count, resent=False):
+        """
+        Отправка с повторами. resent - часть батча могла уже записаться
+        (половина батча после ошибки на стороне клиента): как и на повторах,
+        дубликаты ключа считаются записанными раньше, а не ошибкой.
+        """
+        written = 0
+        attempt = 0
+
+        while pending:
+            retry = []
+            try:
+                written += count(send(pending))
+            except BulkWriteError as e:
+                written += self._affected(e.details)
+                for error in e.details.get("writeErrors", []):
+                    item = pending[error["index"]]
+                    code = error.get("code")
+                    if is_transient(error):
+                        retry.append(item)
+                    elif code == DUPLICATE_KEY and (self.ignore_duplicates or resent or attempt > 0):
+                        self._count(duplicates=1)
+                    else:
+                        self._dead_letter(item, code, error.get("errmsg"))
+            except (ConnectionFailure, OperationFailure) as e:
+                if not is_transient(e):
+                    raise
+                # Неизвестно, что успело записаться: повторяем весь остаток,
+                # если повтор уже примененных операций ничего не меняет
+                if not self.idempotent:
+                    for item in pending:
+                        self._dead_letter(item, getattr(e, "code", None),
+                                          f"результат неизвестен, повтор не выполнен: {e}")
+                    break
+                retry = pending
+            except Exception as e:
+                # Ошибка до отправки (например, слишком большой документ):
+                # делим батч пополам, чтобы изолировать плохой документ
+                if len(pending) == 1:
+                    self._dead_letter(pending[0], None, f"{type(e).__name__}: {e}")
+                else:
+                    middle = len(pending) // 2
+                    written += self._execute(pending[:middle], send, count, resent=True)
+                    written += self._execute(pending[middle:], send, count, resent=True)
+                break
+
+            pending = retry
+            if not pending:
+                break
+
+            attempt += 1
+            if attempt > self.max_retries:
+                for item in pending:
+                    self._dead_letter(item, None, f"повторы исчерпаны ({self.max_retries})")
+                break
+
+            self._count(retried=len(pending))
+            time.sleep(min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+        return written
+
+    def _count(self, written=0, retried=0, duplicates=0):
+        with self.lock:
+            self.written += written
+            self.retried += retried
+            self.duplicates += duplicates
+
+    def _dead_letter(self, item, code, message):
+        with self.lock:
+            self.dead_lettered += 1
+            self.errors_by_code[code] = self.errors_by_code.get(code, 0) + 1
+
+            if self.dead_letter_path is None:
+                return
+
+            record = {
+                "at": datetime.utcnow(),
+                "collection": self.collection.full_name,
+                "code": code,
+                "errmsg": message,
+                "item": item if isinstance(item, dict) or hasattr(item, "raw") else repr(item),
+            }
+            self.dead_letter_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                f.write(json_util.dumps(record, ensure_ascii=False) + "\n")
+
+    def print_report(self):
+        print(f"\n  ЗАПИСЬ В {self.collection.full_name}:")
+        print(f"    Записано документов: {self.written:,}")
+        print(f"    Повторено после временных ошибок: {self.retried:,}")
+        if self.duplicates:
+            print(f"    Уже были в коллекции (дубликаты _id): {self.duplicates:,}")
+        print(f"    В dead-letter: {self.dead_lettered:,}"
+              + (f" ({self.dead_letter_path})" if self.dead_lettered and self.dead_letter_path else ""))
+        for code, count in sorted(self.errors_by_code.items(), key=lambda item: -item[1]):
+            print(f"      код {code}: {count:,}")
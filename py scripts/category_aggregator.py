@@ -0,0 +1,169 @@
+from datetime import datetime
+
+import pyarrow as pa
+
+from category_cache import ancestor_node_ids, category_node_id, split_category_path
+
+# Ключ категории в снапшоте
+GROUP_KEYS = ['Partner_Name', 'Category_ID', 'Category_FullPathName']
+
+
+def _node_fields(partner_name, path_parts, now, direct_products=0):
+    """Общие поля документа узла дерева (лист или промежуточная категория)"""
+    level = len(path_parts)
+    return {
+        "partner": partner_name,
+        "node_id": category_node_id(partner_name, path_parts),
+        "parent_id": category_node_id(partner_name, path_parts[:-1]) if level > 1 else None,
+        "ancestor_ids": ancestor_node_ids(partner_name, path_parts),
+        "name": path_parts[-1],
+        "path_array": path_parts,
+        "level": level,
+        "parent_path": '/'.join(path_parts[:-1]) if level > 1 else None,
+        "metadata": {
+            # total_products - товары непосредственно в категории (как раньше)
+            "total_products": int(direct_products),
+            "direct_products": int(direct_products),
+            "subtree_products": int(direct_products),
+            "child_count": 0,
+            "last_updated": now or datetime.utcnow()
+        }
+    }
+
+
+def build_category_document(partner_name, category_id, category_path, total_products, now=None):
+    """Документ коллекции categories для комбинации Partner + Category (None для пустого пути)"""
+    if not isinstance(category_path, str):
+        return None
+
+    normalized_path, path_parts = split_category_path(category_path)
+
+    if not path_parts:
+        return None
+
+    return {
+        "_id": f"{partner_name}_{category_id}",
+        "category_id": str(category_id),
+        "path": normalized_path,
+        **_node_fields(partner_name, path_parts, now, total_products)
+    }
+
+
+def build_ancestor_document(partner_name, path_parts, now=None):
+    """Документ промежуточного узла, у которого нет своего Category_ID в снапшоте"""
+    fields = _node_fields(partner_name, list(path_parts), now)
+    return {
+        "_id": fields["node_id"],
+        "category_id": None,
+        "path": '/'.join(path_parts),
+        **fields
+    }
+
+
+def nested_set_intervals(node_keys):
+    """
+    Номера lft/rgt вложенных множеств для узлов (partner, части пути).
+
+    Сортировка кортежей путей дает порядок обхода в глубину (префикс идет
+    раньше продолжений, дети - по имени), поэтому номера выдаются одним
+    проходом со стеком открытых узлов: lft при входе, rgt при выходе.
+    Поддерево X - все узлы с X.lft <= lft <= X.rgt.
+    """
+    intervals = {}
+    stack = []
+    counter = 1
+    for key in sorted(set(node_keys)):
+        partner_name, path_parts = key
+        while stack and not (stack[-1][0] == partner_name
+                             and path_parts[:len(stack[-1][1])] == stack[-1][1]):
+            intervals[stack.pop()][1] = counter
+            counter += 1
+        intervals[key] = [counter, None]
+        counter += 1
+        stack.append(key)
+    while stack:
+        intervals[stack.pop()][1] = counter
+        counter += 1
+    return {key: tuple(interval) for key, interval in intervals.items()}
+
+
+class CategoryAggregator:
+    """
+    Инкрементальный подсчет товаров по категориям в потоке батчей.
+
+    Каждый батч группируется колоночно (Arrow group_by), частичные
+    счетчики складываются в словарь {(partner, category_id, path): count}.
+    Строки с пустыми ключами не учитываются, как и при pandas groupby.
+    """
+
+    def __init__(self, counts=None):
+        self.counts = counts or {}
+        self.rows = 0
+
+    def add(self, batch):
+        grouped = pa.Table.from_batches([batch]).group_by(GROUP_KEYS).aggregate([([], "count_all")])
+        for partner_name, category_id, category_path, count in zip(
+                *(grouped.column(name).to_pylist() for name in GROUP_KEYS + ["count_all"])):
+            if partner_name is None or category_id is None or category_path is None:
+                continue
+            key = (partner_name, category_id, category_path)
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.rows += batch.num_rows
+
+    def state(self):
+        """Счетчики в виде, пригодном для журнала (JSON)"""
+        return [[*key, count] for key, count in self.counts.items()]
+
+    @classmethod
+    def from_state(cls, state):
+        return cls({tuple(key): count for *key, count in state or []})
+
+    def build_documents(self, now=None):
+        """
+        Документы categories для всего дерева по накопленным счетчикам.
+
+        Кроме листьев из снапшота создаются все узлы-предки. Счетчики
+        поддерева сворачиваются одним проходом по уникальным категориям
+        (а не по товарам): прямое число товаров листа прибавляется к
+        subtree_products каждого префикса его пути. Узлы получают номера
+        вложенных множеств lft/rgt (см. nested_set_intervals).
+        """
+        now = now or datetime.utcnow()
+        documents = {}
+        for (partner_name, category_id, category_path), total_products in sorted(self.counts.items()):
+            doc = build_category_document(partner_name, category_id, category_path, total_products, now)
+            if doc is not None:
+                documents[doc["_id"]] = doc
+
+        # Узел дерева: (partner, части пути) -> [прямые товары, товары поддерева, дочерние имена]
+        nodes = {}
+        for doc in documents.values():
+            path_parts = tuple(doc["path_array"])
+            direct = doc["metadata"]["direct_products"]
+            for depth in range(1, len(path_parts) + 1):
+                node = nodes.setdefault((doc["partner"], path_parts[:depth]), [0, 0, set()])
+                node[1] += direct
+                if depth > 1:
+                    nodes[(doc["partner"], path_parts[:depth - 1])][2].add(path_parts[depth - 1])
+            nodes[(doc["partner"], path_parts)][0] += direct
+
+        for doc in documents.values():
+            direct_sum, subtree, children = nodes[(doc["partner"], tuple(doc["path_array"]))]
+            metadata = doc["metadata"]
+            metadata["subtree_products"] = metadata["direct_products"] + subtree - direct_sum
+            metadata["child_count"] = len(children)
+
+        leaf_paths = {(doc["partner"], tuple(doc["path_array"])) for doc in documents.values()}
+        for (partner_name, path_parts), (_, subtree, children) in sorted(nodes.items()):
+            if (partner_name, path_parts) in leaf_paths:
+                continue
+            doc = build_ancestor_document(partner_name, path_parts, now)
+            doc["metadata"]["subtree_products"] = subtree
+            doc["metadata"]["child_count"] = len(children)
+            documents[doc["_id"]] = doc
+
+        intervals = nested_set_intervals(nodes)
+        for doc in documents.values():
+            doc["lft"], doc["rgt"] = intervals[(doc["partner"], tuple(doc["path_array"]))]
+
+        return list(documents.values())
@@ -0,0 +1,120 @@
+import hashlib
+
+
+def split_category_path(category_path):
+    """Нормализованный путь (\\ -> /) и непустые части пути"""
+    normalized_path = category_path.replace('\\', '/')
+    path_parts = [part.strip() for part in normalized_path.split('/') if part.strip()]
+    return normalized_path, path_parts
+
+
+def category_node_id(partner_name, path_parts):
+    """Идентификатор узла дерева категорий: md5 от партнера и нормализованного пути"""
+    key = partner_name + "\x1f" + "/".join(path_parts)
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def ancestor_node_ids(partner_name, path_parts):
+    """
+    node_id всех префиксов пути, от корня до самой категории.
+
+    Хранится в документах массивом ancestor_ids под multikey-индексом:
+    "все товары в поддереве X" - это равенство ancestor_ids = node_id(X).
+    """
+    return [category_node_id(partner_name, path_parts[:depth]) for depth in range(1, len(path_parts) + 1)]
+
+
+class CategoryCache:
+    """
+    Кэш встраиваемых поддокументов category по ключу (partner, Category_ID, путь).
+
+    Разных категорий в снапшоте на порядки меньше, чем предложений
+    (5 261 на 1,35 млн строк), поэтому нормализация пути, разбиение на
+    части и breadcrumbs выполняются один раз на категорию, а все документы
+    с этой категорией ссылаются на один и тот же объект. Поддокументы
+    только читаются при кодировании в BSON и не должны изменяться.
+
+    Для products и offers хранятся свои формы поддокумента; отсутствие
+    категории (пустой путь) тоже кэшируется - как None.
+    """
+
+    def __init__(self):
+        self.products = {}
+        self.offers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.products) + len(self.offers)
+
+    def product_categories(self, partners, category_ids, paths):
+        """Поддокументы category коллекции products для колонок батча (None - пустой путь)"""
+        return self._lookup(self.products, self._build_product, partners, category_ids, paths)
+
+    def offer_categories(self, partners, category_ids, paths):
+        """Поддокументы category коллекции offers для колонок батча"""
+        return self._lookup(self.offers, self._build_offer, partners, category_ids, paths)
+
+    def _lookup(self, entries, build, partners, category_ids, paths):
+        missing = object()
+        get = entries.get
+        misses = 0
+
+        categories = []
+        for key in zip(partners, category_ids, paths):
+            category = get(key, missing)
+            if category is missing:
+                category = entries[key] = build(*key)
+                misses += 1
+            categories.append(category)
+
+        self.misses += misses
+        self.hits += len(categories) - misses
+        return categories
+
+    @staticmethod
+    def _build_product(partner, category_id, category_path):
+        normalized_path, path_parts = split_category_path(category_path)
+        if not path_parts:
+            return None
+
+        return {
+            "id": category_id,
+            "name": path_parts[-1],
+            "full_path": normalized_path,
+            "breadcrumbs": [{"level": level, "name": part} for level, part in enumerate(path_parts, 1)],
+            "ancestor_ids": ancestor_node_ids(partner, path_parts)
+        }
+
+    @staticmethod
+    def _build_offer(partner, category_id, category_path):
+        parts = category_path.split('\\')
+        return {
+            "id": category_id,
+            "path": category_path,
+            "level": len(parts),
+            "parts": parts,
+            "ancestor_ids": ancestor_node_ids(partner, split_category_path(category_path)[1])
+        }
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def stats(self):
+        return {
+            "categories": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 4)
+        }
+
+    def print_report(self):
+        print("\n  КЭШ КАТЕГОРИЙ:")
+        print(f"    Поддокументов построено: {self.misses:,}")
+        print(f"    Повторных использований: {self.hits:,} ({self.hit_rate * 100:.2f}%)")
+
+
+# Общий кэш процесса: его используют все загрузчики и воркеры EncoderStage
+CATEGORY_CACHE = CategoryCache()
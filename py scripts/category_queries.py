@@ -0,0 +1,41 @@
+import re
+
+from category_cache import category_node_id, split_category_path
+
+# Поле массива предков в каждой коллекции
+ANCESTOR_FIELDS = {
+    "products": "category.ancestor_ids",
+    "offers": "category.ancestor_ids",
+    "categories": "ancestor_ids",
+}
+
+# Поле пути категории для сравнения с регулярными выражениями
+PATH_FIELDS = {
+    "products": "category.full_path",
+    "offers": "category.path",
+    "categories": "path",
+}
+
+
+def subtree_filter(partner_name, category_path=None, node_id=None, collection="products"):
+    """
+    Фильтр "категория и все ее подкатегории".
+
+    Компилируется в равенство по multikey-индексу ancestor_ids, поэтому
+    сервер читает ровно ключи поддерева, без сканирования индекса пути.
+    Категорию можно задать путем (через \\ или /) или готовым node_id.
+    """
+    if node_id is None:
+        _, path_parts = split_category_path(category_path)
+        if not path_parts:
+            raise ValueError(f"Пустой путь категории: {category_path!r}")
+        node_id = category_node_id(partner_name, path_parts)
+    return {ANCESTOR_FIELDS[collection]: node_id}
+
+
+def regex_subtree_filter(category_path, anchored=False, collection="products"):
+    """Прежний фильтр поддерева регулярным выражением (для сравнения)"""
+    separator = "\\" if collection == "offers" else "/"
+    _, path_parts = split_category_path(category_path)
+    pattern = re.escape(separator.join(path_parts))
+    return {PATH_FIELDS[collection]: {"$regex": ("^" if anchored else "") + pattern}}
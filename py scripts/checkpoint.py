@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from parquet_stream import iter_record_batches, open_snapshot
+
+
+class LoadCheckpoint:
+    """
+    Журнал загрузки одной целевой коллекции (например ecom_catalog.products).
+
+    Хранит завершенные row group и записанные батчи незавершенных групп,
+    а также произвольное состояние загрузчика. Журнал привязан к файлу
+    снапшота (имя, размер, время изменения) и размеру батча: при другом
+    снапшоте дозагрузка невозможна и загрузка начинается с нуля.
+
+    Батч отмечается только после подтверждения записи, поэтому при
+    дозагрузке повторяется не больше чем батчи, которые были в работе в
+    момент сбоя. Их документы имеют детерминированный _id, и повторная
+    вставка дает только ошибки дубликата ключа.
+    """
+
+    def __init__(self, journal_dir, target, parquet_file, batch_size):
+        self.path = Path(journal_dir) / f"{target}.json"
+        self.target = target
+        self.parquet_file = parquet_file
+        self.batch_size = batch_size
+
+        stat = Path(parquet_file).stat()
+        self.source = {
+            "file": Path(parquet_file).name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "batch_size": batch_size,
+        }
+
+        self.lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.completed_row_groups = set()
+        self.committed_batches = {}
+        self.batches_in_row_group = {}
+        self.state = None
+        self.finished = False
+
+    def resume(self):
+        """Загрузить журнал; True, если он относится к тому же снапшоту"""
+        if not self.path.exists():
+            return False
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            journal = json.load(f)
+
+        if journal.get("source") != self.source:
+            return False
+
+        self.completed_row_groups = set(journal["completed_row_groups"])
+        self.committed_batches = {int(rg): set(batches)
+                                  for rg, batches in journal["committed_batches"].items()}
+        self.state = journal.get("state")
+        self.finished = journal.get("finished", False)
+        return True
+
+    def reset(self):
+        """Начать журнал заново (полная загрузка)"""
+        with self.lock:
+            self._clear()
+            self._save()
+
+    def pending_row_groups(self):
+        num_row_groups = open_snapshot(self.parquet_file).metadata.num_row_groups
+        return [rg for rg in range(num_row_groups) if rg not in self.completed_row_groups]
+
+    def batches(self, columns=None):
+        """
+        Батчи снапшота, которые еще не записаны.
+
+        Возвращает пары ((row group, номер батча), RecordBatch); ключ
+        передается в commit() после записи батча. Полностью завершенные
+        row group не читаются с диска.
+        """
+        current_rg, batch_no = None, 0
+        for rg_index, batch in iter_record_batches(self.parquet_file, columns=columns,
+                                                   batch_size=self.batch_size,
+                                                   row_groups=self.pending_row_groups()):
+            if rg_index != current_rg:
+                if current_rg is not None:
+                    self._row_group_read(current_rg, batch_no)
+                current_rg, batch_no = rg_index, 0
+
+            key = (rg_index, batch_no)
+            batch_no += 1
+            if batch_no - 1 in self.committed_batches.get(rg_index, ()):
+                continue
+            yield key, batch
+
+        if current_rg is not None:
+            self._row_group_read(current_rg, batch_no)
+
+    def _row_group_read(self, rg_index, batch_count):
+        with self.lock:
+            self.batches_in_row_group[rg_index] = batch_count
+            self._complete_if_done(rg_index)
+            self._save()
+
+    def commit(self, key):
+        """Отметить батч как записанный (потокобезопасно)"""
+        rg_index, batch_no = key
+        with self.lock:
+            self.committed_batches.setdefault(rg_index, set()).add(batch_no)
+            self._complete_if_done(rg_index)
+            self._save()
+
+    def commit_row_group(self, rg_index, state=None):
+        """Отметить row group целиком и сохранить состояние загрузчика"""
+        with self.lock:
+            self.completed_row_groups.add(rg_index)
+            self.committed_batches.pop(rg_index, None)
+            if state is not None:
+                self.state = state
+            self._save()
+
+    def finish(self):
+        """Загрузка завершена полностью"""
+        with self.lock:
+            self.finished = True
+            self._save()
+
+    def _complete_if_done(self, rg_index):
+        expected = self.batches_in_row_group.get(rg_index)
+        if expected is not None and len(self.committed_batches.get(rg_index, ())) >= expected:
+            self.completed_row_groups.add(rg_index)
+            self.committed_batches.pop(rg_index, None)
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        journal = {
+            "target": self.target,
+            "source": self.source,
+            "completed_row_groups": sorted(self.completed_row_groups),
+            "committed_batches": {str(rg): sorted(batches)
+                                  for rg, batches in self.committed_batches.items()},
+            "state": self.state,
+            "finished": self.finished,
+            "updated_at": datetime.utcnow().isoformat(),
+        }
+
+        # Атомарная замена: журнал не бывает записан наполовину
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(journal, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -1,12 +1,33 @@
-import pandas as pd
-from pymongo import MongoClient, InsertOne
+from pymongo import MongoClient
 from datetime import datetime
 from pathlib import Path
-import hashlib
+import argparse
 import json
-import sys
 
-def create_categories_collection():
+from bulk_writer import BulkWriter
+from category_aggregator import CategoryAggregator
+from checkpoint import LoadCheckpoint
+from nested_set import stamp_products
+from parquet_stream import iter_record_batches
+from result_cache import ResultCache, bump_version
+
+# Индексы коллекции categories
+CATEGORY_INDEXES = [
+    {"field": "partner", "name": "idx_partner"},
+    {"field": "category_id", "name": "idx_category_id", "unique": False},
+    {"field": "path", "name": "idx_path"},
+    {"field": "level", "name": "idx_level"},
+    {"field": "parent_path", "name": "idx_parent_path"},
+    {"field": "node_id", "name": "idx_node_id"},
+    {"field": "parent_id", "name": "idx_parent_id"},
+    {"field": "ancestor_ids", "name": "idx_ancestor_ids"},
+    {"field": "lft", "name": "idx_lft"},
+    {"field": "metadata.total_products", "name": "idx_total_products"},
+    {"field": "metadata.subtree_products", "name": "idx_subtree_products"},
+    {"field": "metadata.last_updated", "name": "idx_last_updated"}
+]
+
+def create_categories_collection(resume=False):
     """Создание коллекции категорий из Parquet файла"""
     print("=" * 70)
     print("СОЗДАНИЕ КОЛЛЕКЦИИ КАТЕГОРИЙ (categories)")
@@ -32,143 +53,84 @@ def create_categories_collection():
         # Используем базу ecom_catalog как требуется в задании
         db = client.ecom_catalog
         
-        # Удаляем старую коллекцию categories если существует
-        db.categories.drop()
-        print("✓ Коллекция categories очищена")
+        # Журнал контрольных точек: счетчики товаров сохраняются после каждой row group
+        checkpoint = LoadCheckpoint(base_path / "checkpoints", "ecom_catalog.categories",
+                                    parquet_file, batch_size=None)
+        
+        aggregator = CategoryAggregator()
+        if resume and checkpoint.resume():
+            aggregator = CategoryAggregator.from_state(checkpoint.state)
+            print(f"✓ Дозагрузка: завершено row group: {len(checkpoint.completed_row_groups)}")
+        else:
+            checkpoint.reset()
         
         # 2. Чтение данных
-        print("\n2. Чтение Parquet файла...")
+        print("\n2. Чтение Parquet файла (потоково, по row group)...")
         start_time = datetime.now()
         
         # Читаем только необходимые колонки для экономии памяти
         columns = ['Partner_Name', 'Category_ID', 'Category_FullPathName', 'Offer_ID']
-        df = pd.read_parquet(parquet_file, columns=columns)
+        current_rg = None
+        
+        for rg_index, record_batch in iter_record_batches(parquet_file, columns=columns,
+                                                          row_groups=checkpoint.pending_row_groups()):
+            # Row group прочитана целиком: сохраняем счетчики в журнал
+            if current_rg is not None and rg_index != current_rg:
+                checkpoint.commit_row_group(current_rg, state=aggregator.state())
+            current_rg = rg_index
+            
+            # Группировка батча по комбинациям Partner + Category
+            aggregator.add(record_batch)
+        
+        if current_rg is not None:
+            checkpoint.commit_row_group(current_rg, state=aggregator.state())
         
         read_time = (datetime.now() - start_time).total_seconds()
         print(f"✓ Файл прочитан за {read_time:.1f} секунд")
-        print(f"  Строк: {len(df):,}")
+        print(f"  Строк: {aggregator.rows:,}")
         
         # 3. Подготовка данных для категорий
         print("\n3. Обработка категорий...")
         
-        # Группируем по уникальным комбинациям Partner + Category
-        category_groups = df.groupby(['Partner_Name', 'Category_ID', 'Category_FullPathName'])
-        
-        # Создаем список для хранения документов категорий
-        categories_dict = {}
-        total_categories = len(category_groups)
+        total_categories = len(aggregator.counts)
         print(f"  Найдено уникальных комбинаций категорий: {total_categories:,}")
         
-        processed = 0
-        for (partner_name, category_id, category_path), group in category_groups:
-            try:
-                # Проверяем данные
-                if pd.isna(category_path) or not isinstance(category_path, str):
-                    continue
-                
-                # Нормализуем путь: заменяем \ на /
-                normalized_path = category_path.replace('\\', '/')
-                path_parts = [part.strip() for part in normalized_path.split('/') if part.strip()]
-                
-                if not path_parts:
-                    continue
-                
-                # Создаем уникальный ID: "partner_categoryid"
-                doc_id = f"{partner_name}_{category_id}"
-                
-                # Определяем уровень вложенности
-                level = len(path_parts)
-                
-                # Определяем родительский путь
-                parent_path = '/'.join(path_parts[:-1]) if level > 1 else None
-                
-                # Название категории - последний элемент пути
-                category_name = path_parts[-1]
-                
-                # Количество товаров в категории
-                total_products = len(group)
-                
-                # Создаем документ категории
-                category_doc = {
-                    "_id": doc_id,
-                    "partner": partner_name,
-                    "category_id": str(category_id),
-                    "name": category_name,
-                    "path": normalized_path,
-                    "path_array": path_parts,
-                    "level": level,
-                    "parent_path": parent_path,
-                    "metadata": {
-                        "total_products": int(total_products),
-                        "last_updated": datetime.utcnow()
-                    }
-                }
-                
-                categories_dict[doc_id] = category_doc
-                processed += 1
-                
-                # Прогресс
-                if processed % 1000 == 0:
-                    percent = processed / total_categories * 100
-                    print(f"  Обработано: {processed:,}/{total_categories:,} ({percent:.1f}%)")
-                    
-            except Exception as e:
-                print(f"  Ошибка обработки категории {partner_name}/{category_id}: {e}")
-                continue
-        
-        print(f"✓ Обработано категорий: {len(categories_dict):,}")
+        # Листья из снапшота и все узлы-предки с товарами поддерева
+        categories_list = aggregator.build_documents()
+        leaf_count = sum(1 for doc in categories_list if doc["category_id"] is not None)
+        
+        print(f"✓ Узлов дерева: {len(categories_list):,}")
+        print(f"  Категорий из снапшота: {leaf_count:,}")
+        print(f"  Промежуточных узлов: {len(categories_list) - leaf_count:,}")
         
         # 4. Вставка категорий в MongoDB
         print("\n4. Вставка категорий в MongoDB...")
         
-        # Преобразуем словарь в список
-        categories_list = list(categories_dict.values())
-        
-        # Вставляем пачками по 1000
-        batch_size = 1000
-        total_inserted = 0
+        # Удаляем старую коллекцию categories: документы строятся заново из счетчиков
+        db.categories.drop()
+        # Отчеты по старым данным не используются, даже если загрузка упадет
+        bump_version(db.categories)
+        print("✓ Коллекция categories очищена")
         
-        for i in range(0, len(categories_list), batch_size):
-            batch = categories_list[i:i + batch_size]
-            
-            try:
-                result = db.categories.insert_many(batch, ordered=False)
-                inserted_count = len(result.inserted_ids)
-                total_inserted += inserted_count
-                
-                percent = (i + len(batch)) / len(categories_list) * 100
-                print(f"  Вставлено: {total_inserted:,}/{len(categories_list):,} ({percent:.1f}%)")
-                
-            except Exception as e:
-                print(f"  Ошибка вставки батча {i//batch_size}: {e}")
-                # Пробуем вставить по одному
-                for doc in batch:
-                    try:
-                        db.categories.insert_one(doc)
-                        total_inserted += 1
-                    except:
-                        pass
+        total_inserted = insert_categories(
+            db, categories_list,
+            dead_letter_path=base_path / "dead_letter" / "ecom_catalog.categories.jsonl")
         
         print(f"✓ Всего вставлено категорий: {total_inserted:,}")
+        checkpoint.finish()
         
         # 5. Создание индексов
         print("\n5. Создание индексов...")
         
-        indexes = [
-            {"field": "partner", "name": "idx_partner"},
-            {"field": "category_id", "name": "idx_category_id", "unique": False},
-            {"field": "path", "name": "idx_path"},
-            {"field": "level", "name": "idx_level"},
-            {"field": "parent_path", "name": "idx_parent_path"},
-            {"field": "metadata.total_products", "name": "idx_total_products"}
-        ]
+        create_category_indexes(db)
         
-        for idx in indexes:
-            try:
-                db.categories.create_index([(idx["field"], 1)], name=idx["name"])
-                print(f"  ✓ Индекс создан: {idx['name']}")
-            except Exception as e:
-                print(f"  ✗ Ошибка создания индекса {idx['name']}: {e}")
+        # Товарам - lft их листовой категории для запросов поддерева диапазоном
+        stamped = stamp_products(db, categories_list)
+        print(f"  category.lft проставлен товарам: {stamped:,}")
+        
+        # Закэшированные отчеты по старым данным больше не используются
+        bump_version(db.categories)
+        bump_version(db.products)
         
         # 6. Статистика
         print("\n6. Сбор статистики...")
@@ -190,7 +152,10 @@ def create_categories_collection():
             {"$sort": {"_id": 1}}
         ]
         
-        level_stats = list(db.categories.aggregate(pipeline))
+        # Через кэш результатов: повторный запуск на тех же данных - одно чтение
+        cache = ResultCache(client)
+        cache.ensure_indexes()
+        level_stats = cache.aggregate(db.categories, pipeline)
         
         print(f"\n  РАСПРЕДЕЛЕНИЕ КАТЕГОРИЙ ПО УРОВНЯМ:")
         for stat in level_stats:
@@ -198,6 +163,17 @@ def create_categories_collection():
             print(f"      Товаров всего: {stat['total_products_sum']:,}")
             print(f"      Среднее товаров на категорию: {stat['avg_products_per_category']:.1f}")
         
+        # Корни дерева: счетчики поддерева читаются из документа, без пересчета по products
+        print(f"\n  КОРНЕВЫЕ КАТЕГОРИИ (товаров в поддереве):")
+        roots = db.categories.find(
+            {"level": 1},
+            {"name": 1, "metadata.subtree_products": 1, "metadata.child_count": 1}
+        ).sort("metadata.subtree_products", -1).limit(5)
+        
+        for cat in roots:
+            print(f"    {cat['name'][:40]}: {cat['metadata']['subtree_products']:,} "
+                  f"(подкатегорий: {cat['metadata']['child_count']})")
+        
         # Топ-5 категорий по количеству товаров
         print(f"\n  ТОП-5 КАТЕГОРИЙ ПО КОЛИЧЕСТВУ ТОВАРОВ:")
         top_categories = db.categories.find(
@@ -218,8 +194,10 @@ def create_categories_collection():
             "generated_at": datetime.utcnow().isoformat(),
             "source_file": str(parquet_file.name),
             "total_categories_created": total_categories_in_db,
+            "leaf_categories": leaf_count,
+            "ancestor_nodes": len(categories_list) - leaf_count,
             "level_distribution": {str(stat["_id"]): stat["count"] for stat in level_stats},
-            "indexes_created": [idx["name"] for idx in indexes],
+            "indexes_created": [idx["name"] for idx in CATEGORY_INDEXES],
             "sample_categories": []
         }
         
@@ -233,7 +211,8 @@ def create_categories_collection():
                 "level": 1,
                 "path": 1,
                 "parent_path": 1,
-                "metadata.total_products": 1
+                "metadata.total_products": 1,
+                "metadata.subtree_products": 1
             }}
         ]))
         
@@ -244,7 +223,8 @@ def create_categories_collection():
                 "level": cat["level"],
                 "path": cat["path"],
                 "parent_path": cat.get("parent_path"),
-                "total_products": cat["metadata"]["total_products"]
+                "total_products": cat["metadata"]["total_products"],
+                "subtree_products": cat["metadata"]["subtree_products"]
             })
         
         # Сохраняем отчет
@@ -357,8 +337,12 @@ top3.forEach((cat, idx) => {
         print('   // Категории с максимальным количеством товаров')
         print('   db.categories.find().sort({"metadata.total_products": -1}).limit(3).pretty()')
         print('')
-        print('   // Поиск по пути')
-        print('   db.categories.find({path: /Строительство/}).limit(3).pretty()')
+        print('   // Поддерево категории (равенство по multikey-индексу ancestor_ids)')
+        print('   const root = db.categories.findOne({path: "Строительство и ремонт"})')
+        print('   db.categories.find({ancestor_ids: root.node_id}).limit(3).pretty()')
+        print('')
+        print('   // Товаров в поддереве - одно чтение по индексу')
+        print('   db.categories.findOne({path: "Строительство и ремонт"}, {"metadata.subtree_products": 1})')
         
         print("\n4. Для задания:")
         print("   - Скриншоты документов с разным уровнем вложенности")
@@ -369,5 +353,36 @@ top3.forEach((cat, idx) => {
         import traceback
         traceback.print_exc()
 
+def insert_categories(db, categories_list, batch_size=1000, dead_letter_path=None):
+    """Вставка документов категорий пачками; возвращает число вставленных"""
+    writer = BulkWriter(db.categories, dead_letter_path=dead_letter_path)
+    total_inserted = 0
+    
+    for i in range(0, len(categories_list), batch_size):
+        batch = categories_list[i:i + batch_size]
+        total_inserted += writer.insert(batch)
+        
+        percent = (i + len(batch)) / len(categories_list) * 100
+        print(f"  Вставлено: {total_inserted:,}/{len(categories_list):,} ({percent:.1f}%)")
+    
+    if writer.dead_lettered:
+        writer.print_report()
+    
+    return total_inserted
+
+def create_category_indexes(db):
+    """Создание индексов коллекции categories"""
+    for idx in CATEGORY_INDEXES:
+        try:
+            db.categories.create_index([(idx["field"], 1)], name=idx["name"])
+            print(f"  ✓ Индекс создан: {idx['name']}")
+        except Exception as e:
+            print(f"  ✗ Ошибка создания индекса {idx['name']}: {e}")
+
 if __name__ == "__main__":
-    create_categories_collection()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Создание коллекции categories")
+    parser.add_argument("--resume", action="store_true",
+                        help="Продолжить прерванное чтение снапшота с контрольной точки")
+    args = parser.parse_args()
+    
+    create_categories_collection(resume=args.resume)
\ No newline at end of file
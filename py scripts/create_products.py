@@ -1,11 +1,77 @@
-import pandas as pd
-from pymongo import MongoClient, InsertOne
+from pymongo import MongoClient
 from datetime import datetime
+from functools import partial
 from pathlib import Path
+import argparse
 import json
-import sys
 
-def create_products_collection():
+from bson_encoder import EncoderStage
+from autocomplete import AUTOCOMPLETE_COLLECTION, autocomplete_rows, create_autocomplete_indexes
+from bulk_writer import BulkWriter
+from category_cache import CATEGORY_CACHE
+from change_consumer import consumer_active
+from checkpoint import LoadCheckpoint
+from delta_sync import DeltaSync, snapshot_duplicates
+from offer_stats import OfferStats, document_counts
+from pagination import pagination_indexes
+from doc_builder import PRODUCT_ID_COLUMNS, build_product_documents, product_ids
+from nested_set import NESTED_SET_PROJECTION, stamp_products
+from parquet_stream import iter_record_batches, snapshot_info
+from result_cache import bump_version
+from sketches import SKETCHES_FILE, ProductSketches
+from write_pool import DEFAULT_WORKERS, WriterPool
+
+# Индексы коллекции products: прежний набор одиночных индексов (профиль legacy)
+PRODUCT_INDEXES = [
+    {"field": "partner", "name": "idx_partner"},
+    {"field": "offer_id", "name": "idx_offer_id", "unique": True},
+    {"field": "type", "name": "idx_type"},
+    {"field": "category.id", "name": "idx_category_id"},
+    {"field": "category.full_path", "name": "idx_category_path"},
+    {"field": "category.ancestor_ids", "name": "idx_category_ancestors"},
+    {"field": "category.lft", "name": "idx_category_lft"},
+    {"field": "name", "name": "idx_name_text", "type": "text", "language": "russian"},
+    {"field": "created_at", "name": "idx_created_at"},
+    {"field": "updated_at", "name": "idx_updated_at"}
+]
+
+# Профиль compact: составные индексы под реальные запросы, списки читаются
+# только из индекса (covered). created_at/updated_at отдельно не индексируются:
+# запросов по ним нет, created_at входит в индексы пагинации (порядок
+# newest). Индексы keyset-пагинации есть только в этом профиле. Одиночные
+# category.id и ancestor_ids покрываются префиксами составных индексов
+COMPACT_PRODUCT_INDEXES = [
+    {"field": "offer_id", "name": "idx_offer_id", "unique": True},
+    {"field": "name", "name": "idx_name_text", "type": "text", "language": "russian"},
+    {"field": "category.lft", "name": "idx_category_lft"},
+    # Категория (+ партнер, тип): список с именами без чтения документов
+    {"keys": [("category.id", 1), ("partner", 1), ("type", 1), ("name", 1), ("_id", 1)],
+     "name": "idx_category_partner_type_name"},
+    # Фильтр по типу (+ категория)
+    {"keys": [("type", 1), ("category.id", 1), ("_id", 1)], "name": "idx_type_category"},
+    # Фильтр по партнеру (+ тип)
+    {"keys": [("partner", 1), ("type", 1), ("_id", 1)], "name": "idx_partner_type"},
+] + pagination_indexes()  # (область, сортировка, _id) для keyset-пагинации
+
+PRODUCT_INDEX_PROFILES = {"legacy": PRODUCT_INDEXES, "compact": COMPACT_PRODUCT_INDEXES}
+DEFAULT_INDEX_PROFILE = "legacy"
+
+def batch_extras(documents, counts=True, sketches=True, autocomplete=True):
+    """
+    Счетчики offer_stats, сводка скетчей и строки autocomplete батча.
+
+    Считаются в EncoderStage по только что построенным dict (в воркере,
+    если кодирование идет в пуле процессов), а не по RawBSONDocument
+    в основном процессе.
+    """
+    return {
+        "counts": document_counts("products", documents) if counts else None,
+        "sketch": ProductSketches.summarize(documents) if sketches else None,
+        "autocomplete": autocomplete_rows(documents) if autocomplete else None,
+    }
+
+def create_products_collection(workers=DEFAULT_WORKERS, queue_size=None, encode_processes=0,
+                               resume=False, delta=False, index_profile=None):
     """Создание коллекции товаров с денормализованными категориями"""
     print("=" * 70)
     print("СОЗДАНИЕ КОЛЛЕКЦИИ ТОВАРОВ (products)")
@@ -31,140 +97,195 @@ def create_products_collection():
         # Используем базу ecom_catalog
         db = client.ecom_catalog
         
-        # Удаляем старую коллекцию products если существует
-        db.products.drop()
-        print("✓ Коллекция products очищена")
+        # Журнал контрольных точек загрузки
+        batch_size = 10000
+        checkpoint = LoadCheckpoint(base_path / "checkpoints", "ecom_catalog.products",
+                                    parquet_file, batch_size)
+        
+        # Счетчики products в ozon_catalog.offer_stats обновляются вместе с каждым батчем,
+        # если их не ведет потребитель change stream
+        offer_stats = OfferStats(client.ozon_catalog.offer_stats, "products",
+                                 enabled=not consumer_active(db))
+        offer_stats.ensure_indexes()
+        if not offer_stats.enabled:
+            print("✓ offer_stats ведет change_consumer.py: счетчики в загрузчике отключены")
+        
+        sync = None
+        resumed = False
+        if delta:
+            # Delta-sync идемпотентен: журнал не нужен, коллекция не удаляется
+            checkpoint = None
+            sync = DeltaSync(db.products, snapshot_duplicates(parquet_file, product_ids, PRODUCT_ID_COLUMNS))
+            print(f"✓ Режим delta-sync: документов в коллекции {sync.existing:,}")
+        elif resume and checkpoint.resume():
+            resumed = True
+            print(f"✓ Дозагрузка: завершено row group: {len(checkpoint.completed_row_groups)}"
+                  + (" (загрузка уже была завершена)" if checkpoint.finished else ""))
+        else:
+            # Удаляем старую коллекцию products если существует
+            db.products.drop()
+            db[AUTOCOMPLETE_COLLECTION].drop()
+            offer_stats.reset()
+            checkpoint.reset()
+            # Отчеты по старым данным не используются, даже если загрузка упадет
+            bump_version(db.products)
+            print("✓ Коллекция products очищена")
         
         # 2. Чтение данных
-        print("\n2. Чтение Parquet файла...")
-        start_time = datetime.now()
+        print("\n2. Чтение Parquet файла (потоково, по row group)...")
         
-        # Читаем все необходимые колонки
-        df = pd.read_parquet(parquet_file)
-        
-        read_time = (datetime.now() - start_time).total_seconds()
-        print(f"✓ Файл прочитан за {read_time:.1f} секунд")
-        print(f"  Строк: {len(df):,}")
+        # Читаем только метаданные: данные идут батчами в цикле ниже
+        info = snapshot_info(parquet_file)
+        print(f"  Строк: {info['rows']:,}")
+        print(f"  Групп строк (row groups): {info['row_groups']}")
         
         # 3. Подготовка данных для товаров
         print("\n3. Обработка товаров...")
         
-        total_rows = len(df)
-        products_list = []
-        batch_size = 10000
+        total_rows = info['rows']
         processed = 0
+        start_time = datetime.now()
         
-        for idx, row in df.iterrows():
-            try:
-                # Базовые поля
-                partner = str(row['Partner_Name'])
-                offer_id = str(row['Offer_ID'])
-                
-                # Создаем уникальный ID: "partner_offerid"
-                doc_id = f"{partner}_{offer_id}"
-                
-                # Обрабатываем категорию
-                category_path = str(row['Category_FullPathName'])
-                normalized_path = category_path.replace('\\', '/')
-                path_parts = [part.strip() for part in normalized_path.split('/') if part.strip()]
-                
-                if not path_parts:
-                    continue
-                
-                # Создаем breadcrumbs (навигационная цепочка)
-                breadcrumbs = []
-                for i, part in enumerate(path_parts, 1):
-                    breadcrumbs.append({
-                        "level": i,
-                        "name": part
-                    })
-                
-                # Создаем документ товара
-                product_doc = {
-                    "_id": doc_id,
-                    "partner": partner,
-                    "offer_id": offer_id,
-                    "name": str(row['Offer_Name']),
-                    "type": str(row['Offer_Type']),
-                    "category": {
-                        "id": str(row['Category_ID']),
-                        "name": path_parts[-1],  # Последний элемент пути
-                        "full_path": normalized_path,
-                        "breadcrumbs": breadcrumbs
-                    },
-                    "created_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow()
-                }
-                
-                products_list.append(product_doc)
-                processed += 1
-                
-                # Вставляем пачками для экономии памяти
-                if len(products_list) >= batch_size:
-                    insert_batch(db, products_list, processed, total_rows)
-                    products_list = []
-                
-                # Прогресс каждые 100k записей
-                if processed % 100000 == 0:
-                    percent = processed / total_rows * 100
-                    print(f"  Обработано: {processed:,}/{total_rows:,} ({percent:.1f}%)")
-                    
-            except Exception as e:
-                # print(f"  Ошибка обработки товара {idx}: {e}")
+        # Запись идет в пуле потоков, пока основной поток строит следующие батчи.
+        # Постоянные ошибки записи уходят в dead-letter файл
+        writer = BulkWriter(db.products,
+                            dead_letter_path=base_path / "dead_letter" / "ecom_catalog.products.jsonl",
+                            ignore_duplicates=resumed)
+        pool = WriterPool(db.products, workers=workers, queue_size=queue_size,
+                          write=writer.write if sync is not None else writer.insert)
+        print(f"  Потоков записи: {workers}")
+        
+        # Скетчи описывают всю коллекцию только при полной загрузке: при дозагрузке
+        # часть батчей уже записана, а delta-sync удаляет документы
+        sketches = ProductSketches() if sync is None and not resumed else None
+        
+        # Сборка документов и (опционально) кодирование в BSON в пуле процессов
+        # вместе со счетчиками, скетчами и autocomplete батча. Для delta-sync
+        # нужны сами документы, поэтому кодирование в основном процессе
+        encoder = EncoderStage(build_product_documents, processes=0 if sync else encode_processes,
+                               derive=None if sync else partial(batch_extras, counts=offer_stats.enabled,
+                                                                       sketches=sketches is not None))
+        print(f"  Кодирование BSON: {encoder.mode}")
+        
+        # Подсказки по названиям строятся вместе с загрузкой; _id строк детерминированы,
+        # поэтому дозагрузка безопасна. После delta-sync - autocomplete.py --rebuild
+        autocomplete_pool = None
+        if sync is None:
+            autocomplete_writer = BulkWriter(db[AUTOCOMPLETE_COLLECTION], ignore_duplicates=resumed)
+            autocomplete_pool = WriterPool(db[AUTOCOMPLETE_COLLECTION], workers=workers, queue_size=queue_size,
+                                           write=autocomplete_writer.insert)
+        
+        if checkpoint is not None:
+            batches = checkpoint.batches()
+            commit = checkpoint.commit
+        else:
+            batches = (((rg_index, None), batch) for rg_index, batch
+                       in iter_record_batches(parquet_file, batch_size=batch_size))
+            commit = lambda key: None
+        
+        # Батч попадает в журнал только после подтверждения записи
+        for key, products_list, extras, error in encoder.imap(batches):
+            if error is not None:
+                print(f"  Ошибка обработки батча (row group {key[0]}): {error}")
                 continue
-        
-        # Вставляем оставшиеся документы
-        if products_list:
-            insert_batch(db, products_list, processed, total_rows)
-        
-        print(f"✓ Всего обработано товаров: {processed:,}")
+            
+            if sync is None:
+                # Счетчики прибавляются после записи, затем батч отмечается в журнале
+                def on_done(inserted, key=key, documents=products_list, counts=extras["counts"]):
+                    offer_stats.inserted(db.products, documents, inserted, counts)
+                    commit(key)
+            else:
+                # Пишем только новые и изменившиеся предложения
+                products_list = sync.operations(products_list)
+                increments = offer_stats.delta(db.products, sync.batch_inserted, sync.batch_changed)
+                on_done = lambda written, increments=increments: offer_stats.apply(increments)
+            
+            if not products_list:
+                commit(key)
+                continue
+            
+            if sketches is not None:
+                sketches.add_summary(extras["sketch"])
+            if autocomplete_pool is not None:
+                autocomplete_pool.submit(extras["autocomplete"])
+            
+            previous = processed
+            processed += len(products_list)
+            pool.submit(products_list, on_done=on_done)
+            
+            # Прогресс каждые 100k записей
+            if processed // 100000 > previous // 100000:
+                percent = processed / total_rows * 100
+                print(f"  Обработано: {processed:,}/{total_rows:,} ({percent:.1f}%)")
+        
+        # Удаляем предложения, которых больше нет в снапшоте
+        if sync is not None:
+            for doc_ids, operations in sync.delete_operations():
+                decrements = offer_stats.removed(db.products, doc_ids)
+                pool.submit(operations, on_done=lambda written, decrements=decrements: offer_stats.apply(decrements))
+        
+        # Дожидаемся записи последних батчей
+        encoder.close()
+        pool.close()
+        if autocomplete_pool is not None:
+            autocomplete_pool.close()
+        if sync is not None:
+            offer_stats.prune(db.products)
+        if checkpoint is not None:
+            checkpoint.finish()
+        
+        load_time = (datetime.now() - start_time).total_seconds()
+        if sync is not None:
+            print(f"✓ Delta-sync завершен за {load_time:.1f} секунд")
+            print(f"  Операций записи: {processed:,}, затронуто документов: {pool.total_documents:,}")
+            sync.print_report()
+        else:
+            print(f"✓ Всего обработано товаров: {processed:,} за {load_time:.1f} секунд")
+            print(f"  Вставлено: {pool.total_documents:,}")
+        if encoder.executor is None:
+            # В пуле процессов у каждого воркера свой кэш
+            CATEGORY_CACHE.print_report()
+        writer.print_report()
+        pool.print_report()
+        
+        if sketches is not None:
+            sketches_file = base_path / SKETCHES_FILE
+            sketches.save(sketches_file)
+            print(f"✓ Скетчи products сохранены: {sketches_file}")
+        else:
+            # Скетчи описывают прошлую полную загрузку: после дозагрузки или
+            # delta-sync они разошлись бы с коллекцией
+            (base_path / SKETCHES_FILE).unlink(missing_ok=True)
+            print(f"  Скетчи {SKETCHES_FILE} удалены (дозагрузка или delta-sync), "
+                  f"--approx доступен после полной загрузки")
         
         # 4. Создание индексов
         print("\n4. Создание индексов...")
         
-        indexes = [
-            {"field": "partner", "name": "idx_partner"},
-            {"field": "offer_id", "name": "idx_offer_id", "unique": True},
-            {"field": "type", "name": "idx_type"},
-            {"field": "category.id", "name": "idx_category_id"},
-            {"field": "category.full_path", "name": "idx_category_path"},
-            {"field": "name", "name": "idx_name_text", "type": "text"},
-            {"field": "created_at", "name": "idx_created_at"},
-            {"field": "updated_at", "name": "idx_updated_at"}
-        ]
-        
-        for idx in indexes:
-            try:
-                if idx.get("type") == "text":
-                    db.products.create_index([(idx["field"], "text")], name=idx["name"])
-                else:
-                    db.products.create_index([(idx["field"], 1)], name=idx["name"], 
-                                            unique=idx.get("unique", False))
-                print(f"  ✓ Индекс создан: {idx['name']}")
-            except Exception as e:
-                print(f"  ✗ Ошибка создания индекса {idx['name']}: {e}")
-        
-        # 5. Статистика (упрощенная, без ошибок в агрегациях)
+        create_product_indexes(db, index_profile)
+        if autocomplete_pool is not None:
+            create_autocomplete_indexes(db[AUTOCOMPLETE_COLLECTION])
+            print(f"  ✓ Строк autocomplete: {autocomplete_pool.total_documents:,}")
+        else:
+            print("  Коллекция autocomplete не обновлялась (delta-sync): autocomplete.py --rebuild")
+        
+        # Номера вложенных множеств листовых категорий (если categories уже построена)
+        stamped = stamp_products(db, db.categories.find({"category_id": {"$ne": None}}, NESTED_SET_PROJECTION))
+        print(f"  category.lft проставлен товарам: {stamped:,}")
+        
+        # Закэшированные отчеты по старым данным больше не используются
+        bump_version(db.products)
+        
+        # 5. Статистика из счетчиков offer_stats (без $group по коллекции)
         print("\n5. Сбор статистики...")
         
         # Общая статистика
-        total_products = db.products.count_documents({})
+        total_products = offer_stats.total()
         print(f"  Всего товаров в базе: {total_products:,}")
         
         # Топ-5 типов товаров (упрощенный запрос)
         print(f"\n  ТОП-5 ТИПОВ ТОВАРОВ:")
-        top_types_cursor = db.products.aggregate([
-            {
-                "$group": {
-                    "_id": "$type",
-                    "count": {"$sum": 1}
-                }
-            },
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ])
-        
-        top_types = list(top_types_cursor)
+        top_types = offer_stats.top("type", limit=5)
         for i, type_stat in enumerate(top_types, 1):
             type_name = type_stat['_id'][:50] + "..." if len(type_stat['_id']) > 50 else type_stat['_id']
             percentage = (type_stat['count'] / total_products * 100) if total_products > 0 else 0
@@ -174,17 +295,7 @@ def create_products_collection():
         
         # Распределение по партнерам
         print(f"\n  РАСПРЕДЕЛЕНИЕ ПО ПАРТНЕРАМ:")
-        partner_stats_cursor = db.products.aggregate([
-            {
-                "$group": {
-                    "_id": "$partner",
-                    "count": {"$sum": 1}
-                }
-            },
-            {"$sort": {"count": -1}}
-        ])
-        
-        partner_stats = list(partner_stats_cursor)
+        partner_stats = offer_stats.top("partner")
         for stat in partner_stats:
             percentage = (stat['count'] / total_products * 100) if total_products > 0 else 0
             print(f"    Партнер: {stat['_id']}")
@@ -192,22 +303,7 @@ def create_products_collection():
         
         # Распределение по уровням категорий
         print(f"\n  РАСПРЕДЕЛЕНИЕ ПО УРОВНЯМ КАТЕГОРИЙ:")
-        level_stats_cursor = db.products.aggregate([
-            {
-                "$addFields": {
-                    "category_level": {"$size": "$category.breadcrumbs"}
-                }
-            },
-            {
-                "$group": {
-                    "_id": "$category_level",
-                    "count": {"$sum": 1}
-                }
-            },
-            {"$sort": {"_id": 1}}
-        ])
-        
-        level_stats = list(level_stats_cursor)
+        level_stats = offer_stats.top("depth", by_value=True)
         for stat in level_stats:
             percentage = (stat['count'] / total_products * 100) if total_products > 0 else 0
             print(f"    Уровень {stat['_id']}: {stat['count']:,} товаров ({percentage:.1f}%)")
@@ -309,23 +405,82 @@ def create_products_collection():
         import traceback
         traceback.print_exc()
 
-def insert_batch(db, batch, processed, total):
-    """Вставка батча документов"""
-    try:
-        db.products.insert_many(batch, ordered=False)
-        percent = processed / total * 100
-        print(f"  Вставлено: {processed:,}/{total:,} ({percent:.1f}%)")
-    except Exception as e:
-        print(f"  Ошибка вставки батча: {e}")
-        # Пробуем вставить по одному
-        success = 0
-        for doc in batch:
-            try:
-                db.products.insert_one(doc)
-                success += 1
-            except:
-                pass
-        print(f"  Вставлено по одному: {success}/{len(batch)}")
+def drop_text_index_with_other_language(collection, language):
+    """
+    Удалить текстовый индекс коллекции, созданный с другим default_language.
+
+    Опции индекса не изменить, а create_index с другим языком падает с
+    IndexOptionsConflict (текстовый индекс у коллекции один), поэтому
+    индекс удаляется и создается заново. Используется и для offers.
+    """
+    for name, info in collection.index_information().items():
+        if "default_language" in info and info["default_language"] != language:
+            collection.drop_index(name)
+            print(f"  ✓ Индекс удален: {name} (язык {info['default_language']}, нужен {language})")
+
+def create_product_indexes(db, profile=None, collection=None):
+    """
+    Создание индексов коллекции products по профилю (legacy или compact).
+
+    Без profile создается набор DEFAULT_INDEX_PROFILE, остальные индексы
+    коллекции не трогаются. Явно заданный профиль удаляет индексы, которых
+    в нем нет: при смене профиля на существующей коллекции остается ровно
+    его набор.
+    """
+    collection = db.products if collection is None else collection
+    indexes = PRODUCT_INDEX_PROFILES[profile or DEFAULT_INDEX_PROFILE]
+    print(f"  Профиль индексов: {profile or DEFAULT_INDEX_PROFILE}"
+          + ("" if profile else " (по умолчанию, другие индексы сохраняются)"))
+
+    if profile is not None:
+        wanted = {idx["name"] for idx in indexes} | {"_id_"}
+        extra = [name for name in collection.index_information() if name not in wanted]
+        if extra:
+            print(f"  Индексы вне профиля {profile} удаляются: {', '.join(extra)}")
+            for name in extra:
+                collection.drop_index(name)
+                print(f"  ✓ Индекс удален: {name}")
+
+    existing = collection.index_information()
+    for idx in indexes:
+        if idx.get("type") == "text":
+            drop_text_index_with_other_language(collection, idx.get("language", "english"))
+        elif idx["name"] in existing and existing[idx["name"]]["key"] != idx.get("keys", [(idx["field"], 1)]):
+            # Индекс с тем же именем, но другими полями (например, idx_page_*_newest
+            # по updated_at): create_index упал бы с конфликтом
+            collection.drop_index(idx["name"])
+            print(f"  ✓ Индекс удален: {idx['name']} (изменились поля)")
+
+    for idx in indexes:
+        try:
+            if idx.get("type") == "text":
+                collection.create_index([(idx["field"], "text")], name=idx["name"],
+                                        default_language=idx.get("language", "english"))
+            else:
+                # Составной индекс задается списком keys, одиночный - полем field
+                collection.create_index(idx.get("keys", [(idx["field"], 1)]), name=idx["name"], 
+                                        unique=idx.get("unique", False))
+            print(f"  ✓ Индекс создан: {idx['name']}")
+        except Exception as e:
+            print(f"  ✗ Ошибка создания индекса {idx['name']}: {e}")
 
 if __name__ == "__main__":
-    create_products_collection()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Создание коллекции products")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Число потоков записи")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="Максимум батчей в очереди записи (по умолчанию 2 x workers)")
+    parser.add_argument("--encode-processes", type=int, default=0,
+                        help="Процессов для сборки и BSON-кодирования документов (0 - в основном процессе)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Продолжить прерванную загрузку с контрольной точки")
+    parser.add_argument("--delta", action="store_true",
+                        help="Синхронизировать коллекцию со снапшотом: писать только изменения")
+    parser.add_argument("--index-profile", choices=list(PRODUCT_INDEX_PROFILES), default=None,
+                        help="Набор индексов: legacy - одиночные, compact - составные покрывающие; "
+                             "индексы вне профиля удаляются (по умолчанию legacy без удаления)")
+    args = parser.parse_args()
+    
+    create_products_collection(workers=args.workers, queue_size=args.queue_size,
+                               encode_processes=args.encode_processes, resume=args.resume,
+                               delta=args.delta, index_profile=args.index_profile)
\ No newline at end of file
@@ -0,0 +1,116 @@
+from pymongo import DeleteOne, UpdateOne
+from collections import Counter
+
+from parquet_stream import iter_record_batches
+
+# Размер пачки операций удаления исчезнувших предложений
+DELETE_BATCH_SIZE = 10000
+
+
+def load_fingerprints(collection):
+    """Отпечатки source_hash всех документов коллекции: {_id: source_hash}"""
+    cursor = collection.find({}, {"source_hash": 1}).batch_size(50000)
+    return {doc["_id"]: doc.get("source_hash") for doc in cursor}
+
+
+def snapshot_duplicates(parquet_file, doc_ids, columns):
+    """
+    _id, которые встречаются в снапшоте больше одного раза: {_id: число строк}.
+
+    Отдельный проход читает только колонки _id (columns); doc_ids(batch)
+    строит из них колонку _id так же, как сборщик документов.
+    """
+    counts = Counter()
+    for _, batch in iter_record_batches(parquet_file, columns=columns):
+        counts.update(doc_ids(batch).to_pylist())
+    return {doc_id: count for doc_id, count in counts.items() if count > 1}
+
+
+class DeltaSync:
+    """
+    Синхронизация коллекции со снапшотом по отпечаткам строк.
+
+    Перед чтением снапшота загружаются пары (_id, source_hash) текущей
+    коллекции. Для каждого собранного документа:
+    - _id нет в коллекции - UpdateOne(upsert=True) с created_at через $setOnInsert;
+    - source_hash отличается - UpdateOne с $set всех полей и новым updated_at;
+    - source_hash совпадает - операций нет, updated_at не меняется.
+    _id, которые не встретились в снапшоте, удаляются через DeleteOne.
+    Объем записи и oplog пропорционален числу изменений, а не размеру каталога.
+    Операции пишутся через BulkWriter.write.
+
+    duplicates - повторяющиеся _id снапшота (snapshot_duplicates()): из
+    повторов учитывается только последняя строка, остальные пропускаются,
+    чтобы одно предложение не считалось новым несколько раз.
+    """
+
+    def __init__(self, collection, duplicates=None):
+        self.collection = collection
+        self.fingerprints = load_fingerprints(collection)
+        self.existing = len(self.fingerprints)
+        self.duplicates = dict(duplicates or {})
+        self.inserted = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.skipped_duplicates = 0
+        # Новые и изменившиеся документы последнего батча (для счетчиков offer_stats)
+        self.batch_inserted = []
+        self.batch_changed = []
+
+    def operations(self, documents):
+        """Операции для батча документов из снапшота"""
+        operations = []
+        missing = object()
+        self.batch_inserted, self.batch_changed = [], []
+
+        for doc in documents:
+            remaining = self.duplicates.get(doc["_id"])
+            if remaining is not None:
+                if remaining > 1:
+                    # Дальше в снапшоте есть более поздняя строка с тем же _id
+                    self.duplicates[doc["_id"]] = remaining - 1
+                    self.skipped_duplicates += 1
+                    continue
+                del self.duplicates[doc["_id"]]
+
+            old_hash = self.fingerprints.pop(doc["_id"], missing)
+            if old_hash == doc["source_hash"]:
+                self.unchanged += 1
+                continue
+
+            fields = {key: value for key, value in doc.items() if key not in ("_id", "created_at")}
+            operations.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": fields, "$setOnInsert": {"created_at": doc["created_at"]}},
+                upsert=True
+            ))
+
+            if old_hash is missing:
+                self.inserted += 1
+                self.batch_inserted.append(doc)
+            else:
+                self.changed += 1
+                self.batch_changed.append(doc)
+
+        return operations
+
+    def delete_operations(self, batch_size=DELETE_BATCH_SIZE):
+        """Пачки (_id, DeleteOne) для документов, которых больше нет в снапшоте"""
+        vanished = list(self.fingerprints)
+        self.fingerprints = {}
+        self.deleted = len(vanished)
+
+        for start in range(0, len(vanished), batch_size):
+            doc_ids = vanished[start:start + batch_size]
+            yield doc_ids, [DeleteOne({"_id": doc_id}) for doc_id in doc_ids]
+
+    def print_report(self):
+        print("\n  DELTA-SYNC:")
+        print(f"    Было в коллекции: {self.existing:,}")
+        print(f"    Новых: {self.inserted:,}")
+        print(f"    Изменившихся: {self.changed:,}")
+        print(f"    Без изменений: {self.unchanged:,}")
+        print(f"    Удаленных: {self.deleted:,}")
+        if self.skipped_duplicates:
+            print(f"    Повторов _id в снапшоте (учтена последняя строка): {self.skipped_duplicates:,}")
@@ -0,0 +1,153 @@
+import hashlib
+from datetime import datetime
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from category_cache import CATEGORY_CACHE
+
+
+def column_as_str(batch, name):
+    """Колонка батча как строки; null превращается в 'None', как str(None)"""
+    column = batch.column(name)
+    if not pa.types.is_string(column.type):
+        column = pc.cast(column, pa.string())
+    return pc.fill_null(column, "None")
+
+
+# Колонки снапшота, от которых зависит содержимое документа
+SOURCE_COLUMNS = ['Partner_Name', 'Offer_ID', 'Offer_Name', 'Offer_Type',
+                  'Category_ID', 'Category_FullPathName']
+
+
+# Колонки снапшота, из которых складывается _id документа
+PRODUCT_ID_COLUMNS = ['Partner_Name', 'Offer_ID']
+OFFER_ID_COLUMNS = ['Offer_ID']
+
+
+def product_ids(batch):
+    """_id документов products: "<partner>_<offer_id>" (колонка Arrow)"""
+    return pc.binary_join_element_wise(column_as_str(batch, 'Partner_Name'), column_as_str(batch, 'Offer_ID'), '_')
+
+
+def offer_ids(batch):
+    """_id документов offers: Offer_ID (колонка Arrow)"""
+    return column_as_str(batch, 'Offer_ID')
+
+
+def source_hashes(batch):
+    """
+    Отпечатки исходных строк батча (blake2b по всем колонкам SOURCE_COLUMNS).
+
+    Хранятся в документе как source_hash: по ним delta-sync находит
+    изменившиеся предложения без сравнения документов целиком. Строки
+    склеиваются колоночной операцией, в Python остается только вызов
+    blake2b на строку: ядра криптографического хэша в Arrow нет.
+    """
+    joined = pc.binary_join_element_wise(*(column_as_str(batch, name) for name in SOURCE_COLUMNS), '\x1f')
+    joined = pc.cast(joined, pa.binary())
+    return list(map(_digest, joined.to_pylist()))
+
+
+def _digest(value):
+    return hashlib.blake2b(value, digest_size=16).hexdigest()
+
+
+# Колонки ключа категории: поддокумент зависит только от них
+CATEGORY_KEY_COLUMNS = ['Partner_Name', 'Category_ID', 'Category_FullPathName']
+
+
+def row_categories(batch, resolve):
+    """
+    Поддокументы category для всех строк батча.
+
+    Ключ (partner, Category_ID, путь) кодируется словарем: через кэш
+    (resolve - CategoryCache.product_categories/offer_categories) проходят
+    только уникальные ключи батча, а строки получают свой поддокумент
+    выборкой по коду словаря (take над массивом объектов numpy).
+    """
+    columns = [column_as_str(batch, name) for name in CATEGORY_KEY_COLUMNS]
+    codes = pc.dictionary_encode(pc.binary_join_element_wise(*columns, '\x1f')).indices
+    codes = codes.to_numpy(zero_copy_only=False)
+
+    # Первая строка каждого кода: коды словаря идут в порядке первого появления
+    _, first_rows = np.unique(codes, return_index=True)
+    first_rows = pa.array(first_rows)
+    categories = resolve(*(pc.take(column, first_rows).to_pylist() for column in columns))
+
+    unique = np.empty(len(categories), dtype=object)
+    unique[:] = categories
+    return unique[codes]
+
+
+def build_product_documents(batch, now=None, cache=None):
+    """
+    Построение документов коллекции products для целого RecordBatch.
+
+    Склейка _id выполняется над колонками, метка времени одна на батч.
+    Поддокумент category берется из CategoryCache по уникальным ключам
+    батча (row_categories): документы с одной категорией разделяют объект.
+    Строки с пустым путем категории пропускаются, как и раньше.
+    """
+    now = now or datetime.utcnow()
+    if cache is None:
+        cache = CATEGORY_CACHE
+
+    categories = row_categories(batch, cache.product_categories)
+    keep = np.not_equal(categories, None)
+    if not keep.all():
+        batch = batch.filter(pa.array(keep))
+        categories = categories[keep]
+
+    documents = []
+    for doc_id, partner, offer_id, name, offer_type, category, source_hash in zip(
+            product_ids(batch).to_pylist(),
+            column_as_str(batch, 'Partner_Name').to_pylist(),
+            column_as_str(batch, 'Offer_ID').to_pylist(),
+            column_as_str(batch, 'Offer_Name').to_pylist(),
+            column_as_str(batch, 'Offer_Type').to_pylist(),
+            categories.tolist(),
+            source_hashes(batch)):
+        documents.append({
+            "_id": doc_id,
+            "partner": partner,
+            "offer_id": offer_id,
+            "name": name,
+            "type": offer_type,
+            "category": category,
+            "source_hash": source_hash,
+            "created_at": now,
+            "updated_at": now
+        })
+
+    return documents
+
+
+def build_offer_documents(batch, now=None, cache=None):
+    """Построение документов коллекции ozon_catalog.offers для целого RecordBatch"""
+    now = now or datetime.utcnow()
+    if cache is None:
+        cache = CATEGORY_CACHE
+
+    documents = []
+    for offer_id, name, offer_type, partner, category, source_hash in zip(
+            offer_ids(batch).to_pylist(),
+            column_as_str(batch, 'Offer_Name').to_pylist(),
+            column_as_str(batch, 'Offer_Type').to_pylist(),
+            column_as_str(batch, 'Partner_Name').to_pylist(),
+            row_categories(batch, cache.offer_categories).tolist(),
+            source_hashes(batch)):
+        documents.append({
+            "_id": offer_id,
+            "offer_id": offer_id,
+            "name": name,
+            "offer_type": offer_type,
+            "partner": partner,
+            "category": category,
+            "source_hash": source_hash,
+            "created_at": now,
+            "updated_at": now
+        })
+
+    return documents
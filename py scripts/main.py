@@ -1,11 +1,34 @@
 import pandas as pd
-from pymongo import MongoClient, InsertOne
+from pymongo import MongoClient
 from datetime import datetime
+import argparse
 import time
 from pathlib import Path
 import sys
 
-def load_ozon_data():
+from bulk_writer import BulkWriter
+from category_cache import CATEGORY_CACHE
+from checkpoint import LoadCheckpoint
+from create_products import drop_text_index_with_other_language
+from delta_sync import DeltaSync, snapshot_duplicates
+from offer_stats import OfferStats
+from doc_builder import OFFER_ID_COLUMNS, build_offer_documents, offer_ids
+from parquet_stream import iter_record_batches, snapshot_info
+from result_cache import bump_version
+from write_pool import DEFAULT_WORKERS, WriterPool
+
+# Основные индексы коллекции offers
+OFFER_INDEXES = [
+    {"field": "offer_id", "unique": True},
+    {"field": "category.id"},
+    {"field": "category.path"},
+    {"field": "category.ancestor_ids"},
+    {"field": "partner"},
+    {"field": "offer_type"},
+    {"field": "name", "type": "text", "language": "russian"}  # Текстовый индекс для поиска
+]
+
+def load_ozon_data(workers=DEFAULT_WORKERS, queue_size=None, resume=False, delta=False):
     """Загрузка данных Ozon в MongoDB"""
     print("=" * 70)
     print("ЗАГРУЗКА ДАННЫХ OZON В MONGODB")
@@ -43,122 +66,154 @@ def load_ozon_data():
         # Используем базу ozon_catalog
         db = client.ozon_catalog
         
-        # Очищаем коллекцию
-        db.offers.drop()
-        print("✓ Коллекция 'offers' очищена")
-        
-        # 3. Чтение данных с правильным методом
+        # Журнал контрольных точек загрузки
+        batch_size = 10000
+        checkpoint = LoadCheckpoint(base_path / "checkpoints", "ozon_catalog.offers",
+                                    parquet_file, batch_size)
+        
+        # Счетчики offers в offer_stats обновляются вместе с каждым батчем
+        offer_stats = OfferStats(db.offer_stats, "offers")
+        offer_stats.ensure_indexes()
+        
+        sync = None
+        resumed = False
+        if delta:
+            # Delta-sync идемпотентен: журнал не нужен, коллекция не удаляется
+            checkpoint = None
+            sync = DeltaSync(db.offers, snapshot_duplicates(parquet_file, offer_ids, OFFER_ID_COLUMNS))
+            print(f"✓ Режим delta-sync: документов в коллекции {sync.existing:,}")
+        elif resume and checkpoint.resume():
+            resumed = True
+            print(f"✓ Дозагрузка: завершено row group: {len(checkpoint.completed_row_groups)}"
+                  + (" (загрузка уже была завершена)" if checkpoint.finished else ""))
+        else:
+            # Очищаем коллекцию
+            db.offers.drop()
+            offer_stats.reset()
+            checkpoint.reset()
+            # Отчеты по старым данным не используются, даже если загрузка упадет
+            bump_version(db.offers)
+            print("✓ Коллекция 'offers' очищена")
+        
+        # 3. Чтение метаданных (данные читаются потоково при загрузке)
         print("\n3. Чтение Parquet файла...")
         
-        # Способ 1: Читаем весь файл
-        print("  Чтение данных (это может занять несколько минут)...")
-        start_time = time.time()
-        
-        # Используем правильный метод чтения
-        df = pd.read_parquet(parquet_file)
-        
-        read_time = time.time() - start_time
-        print(f"✓ Файл прочитан за {read_time:.1f} секунд")
-        print(f"  Строк: {len(df):,}")
-        print(f"  Колонок: {len(df.columns)}")
-        print(f"  Поля: {list(df.columns)}")
-        
-        # Показываем пример данных
-        print("\n  Пример данных (первые 3 строки):")
-        print(df.head(3).to_string())
+        # Файл не загружается целиком: берем только метаданные,
+        # строки читаются по row group в цикле загрузки
+        info = snapshot_info(parquet_file)
+        print(f"  Строк: {info['rows']:,}")
+        print(f"  Колонок: {len(info['columns'])}")
+        print(f"  Групп строк (row groups): {info['row_groups']}")
+        print(f"  Поля: {info['columns']}")
         
         # 4. Загрузка в MongoDB (пачками для оптимизации)
         print("\n4. Загрузка данных в MongoDB...")
         
-        batch_size = 10000
-        total_rows = len(df)
-        operations = []
-        inserted_count = 0
+        total_rows = info['rows']
+        rows_read = 0
         
         print(f"  Всего строк для обработки: {total_rows:,}")
         print(f"  Размер батча: {batch_size}")
         print(f"  Примерное количество батчей: {total_rows // batch_size + 1}")
         
+        print(f"  Потоков записи: {workers}")
+        
         start_load_time = time.time()
         
-        for idx, row in df.iterrows():
+        # Вставка идет в пуле потоков параллельно со сборкой следующих батчей.
+        # Постоянные ошибки записи уходят в dead-letter файл
+        writer = BulkWriter(db.offers,
+                            dead_letter_path=base_path / "dead_letter" / "ozon_catalog.offers.jsonl",
+                            ignore_duplicates=resumed)
+        pool = WriterPool(db.offers, workers=workers, queue_size=queue_size,
+                          write=writer.write if sync is not None else writer.insert)
+        
+        if checkpoint is not None:
+            batches = checkpoint.batches()
+            commit = checkpoint.commit
+        else:
+            batches = (((rg_index, None), batch) for rg_index, batch
+                       in iter_record_batches(parquet_file, batch_size=batch_size))
+            commit = lambda key: None
+        
+        # Батч попадает в журнал только после подтверждения записи
+        for key, record_batch in batches:
+            # Показываем пример данных из первого батча
+            if rows_read == 0:
+                print("\n  Пример данных (первые 3 строки):")
+                print(record_batch.slice(0, 3).to_pandas().to_string())
+            
             try:
-                # Создаем документ товара
-                category_path = str(row['Category_FullPathName'])
-                offer_doc = {
-                    "_id": str(row['Offer_ID']),
-                    "offer_id": str(row['Offer_ID']),
-                    "name": str(row['Offer_Name']),
-                    "offer_type": str(row['Offer_Type']),
-                    "partner": str(row['Partner_Name']),
-                    "category": {
-                        "id": str(row['Category_ID']),
-                        "path": category_path,
-                        "level": len(category_path.split('\\')) if category_path else 1,
-                        "parts": category_path.split('\\')
-                    },
-                    "created_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow()
-                }
-                
-                operations.append(InsertOne(offer_doc))
-                inserted_count += 1
-                
-                # Вставляем пачками
-                if len(operations) >= batch_size:
-                    result = db.offers.bulk_write(operations, ordered=False)
-                    operations = []
-                    
-                    # Показываем прогресс
-                    percent = (idx + 1) / total_rows * 100
-                    elapsed = time.time() - start_load_time
-                    speed = (idx + 1) / elapsed if elapsed > 0 else 0
-                    
-                    print(f"  Обработано: {idx + 1:,}/{total_rows:,} ({percent:.1f}%)")
-                    print(f"  Скорость: {speed:.0f} записей/сек")
-                    
+                # Документы строятся колоночно для всего батча сразу
+                documents = build_offer_documents(record_batch)
             except Exception as e:
-                # Пропускаем ошибки в отдельных строках
-                print(f"  Ошибка в строке {idx}: {e}")
+                # Пропускаем батч с ошибкой
+                print(f"  Ошибка в батче (row group {key[0]}): {e}")
+                rows_read += record_batch.num_rows
                 continue
-        
-        # Вставляем оставшиеся документы
-        if operations:
-            result = db.offers.bulk_write(operations, ordered=False)
+            
+            rows_read += record_batch.num_rows
+            if sync is None:
+                # Счетчики прибавляются после записи, затем батч отмечается в журнале
+                def on_done(inserted, key=key, documents=documents):
+                    offer_stats.inserted(db.offers, documents, inserted)
+                    commit(key)
+            else:
+                # Пишем только новые и изменившиеся предложения
+                documents = sync.operations(documents)
+                increments = offer_stats.delta(db.offers, sync.batch_inserted, sync.batch_changed)
+                on_done = lambda written, increments=increments: offer_stats.apply(increments)
+            
+            if not documents:
+                commit(key)
+                continue
+            
+            pool.submit(documents, on_done=on_done)
+            
+            # Показываем прогресс
+            percent = rows_read / total_rows * 100
+            elapsed = time.time() - start_load_time
+            speed = rows_read / elapsed if elapsed > 0 else 0
+            
+            print(f"  Обработано: {rows_read:,}/{total_rows:,} ({percent:.1f}%)")
+            print(f"  Скорость: {speed:.0f} записей/сек")
+        
+        # Удаляем предложения, которых больше нет в снапшоте
+        if sync is not None:
+            for doc_ids, operations in sync.delete_operations():
+                decrements = offer_stats.removed(db.offers, doc_ids)
+                pool.submit(operations, on_done=lambda written, decrements=decrements: offer_stats.apply(decrements))
+        
+        # Дожидаемся записи последних батчей
+        pool.close()
+        if sync is not None:
+            offer_stats.prune(db.offers)
+        if checkpoint is not None:
+            checkpoint.finish()
+        inserted_count = pool.total_documents
         
         total_load_time = time.time() - start_load_time
         print(f"✓ Загрузка завершена за {total_load_time:.1f} секунд")
         print(f"  Всего загружено: {inserted_count:,} документов")
         print(f"  Средняя скорость: {inserted_count/total_load_time:.0f} записей/сек")
+        if sync is not None:
+            sync.print_report()
+        CATEGORY_CACHE.print_report()
+        writer.print_report()
+        pool.print_report()
         
         # 5. Создание индексов
         print("\n5. Создание индексов...")
         
-        # Создаем основные индексы
-        indexes = [
-            {"field": "offer_id", "unique": True},
-            {"field": "category.id"},
-            {"field": "category.path"},
-            {"field": "partner"},
-            {"field": "offer_type"},
-            {"field": "name", "type": "text"}  # Текстовый индекс для поиска
-        ]
-        
-        for idx_info in indexes:
-            field = idx_info["field"]
-            unique = idx_info.get("unique", False)
-            
-            if idx_info.get("type") == "text":
-                db.offers.create_index([(field, "text")])
-                print(f"  ✓ Текстовый индекс создан: {field}")
-            else:
-                db.offers.create_index([(field, 1)], unique=unique)
-                print(f"  ✓ Индекс создан: {field}" + (" (уникальный)" if unique else ""))
+        create_offer_indexes(db)
+        
+        # Закэшированные отчеты по старым данным больше не используются
+        bump_version(db.offers)
         
         # 6. Статистика и проверка
         print("\n6. Статистика базы данных:")
         
-        total_docs = db.offers.count_documents({})
+        total_docs = offer_stats.total()
         print(f"  Всего документов в коллекции: {total_docs:,}")
         
         # Размер коллекции
@@ -167,30 +222,18 @@ def load_ozon_data():
         print(f"  Размер индексов: {stats['indexSize'] / (1024**2):.1f} MB")
         
         # 7. Примеры запросов
-        print("\n7. Примеры агрегационных запросов:")
+        print("\n7. Статистика из offer_stats (без $group по коллекции):")
         
         # Топ-5 категорий по количеству товаров
         print("\n  Топ-5 категорий:")
-        pipeline = [
-            {"$group": {"_id": "$category.path", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ]
-        
-        results = list(db.offers.aggregate(pipeline))
+        results = offer_stats.top("category", limit=5)
         for i, item in enumerate(results, 1):
             cat_name = item['_id'][:50] + "..." if len(item['_id']) > 50 else item['_id']
             print(f"    {i}. {cat_name}: {item['count']:,}")
         
         # Распределение по типам товаров
         print("\n  Распределение по типам товаров (топ-5):")
-        pipeline = [
-            {"$group": {"_id": "$offer_type", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ]
-        
-        results = list(db.offers.aggregate(pipeline))
+        results = offer_stats.top("type", limit=5)
         for item in results:
             type_name = item['_id'][:30] + "..." if len(item['_id']) > 30 else item['_id']
             print(f"    {type_name}: {item['count']:,}")
@@ -206,11 +249,26 @@ def load_ozon_data():
             "loaded_documents": inserted_count,
             "load_time_seconds": total_load_time,
             "load_speed_records_per_second": inserted_count / total_load_time if total_load_time > 0 else 0,
+            "write_errors": {
+                "retried": writer.retried,
+                "dead_lettered": writer.dead_lettered,
+                "by_code": {str(code): count for code, count in writer.errors_by_code.items()}
+            },
+            "writer_workers": [
+                {
+                    "worker": stats.worker_id,
+                    "batches": stats.batches,
+                    "documents": stats.documents,
+                    "busy_seconds": stats.busy_seconds,
+                    "docs_per_second": stats.docs_per_second
+                } for stats in pool.stats
+            ],
             "database": "ozon_catalog",
             "collection": "offers",
-            "indexes": [idx["field"] for idx in indexes],
+            "indexes": [idx["field"] for idx in OFFER_INDEXES],
             "sample_queries": [
-                {"description": "Топ категорий", "pipeline": pipeline[:3]}
+                {"description": "Топ категорий",
+                 "offer_stats": {"source": "offers", "dimension": "category", "sort": {"count": -1}, "limit": 5}}
             ]
         }
         
@@ -232,8 +290,9 @@ def load_ozon_data():
         print("   Коллекция: offers")
         
         print("\n2. Примеры запросов в MongoDB Compass:")
-        print("   • Найти все товары в категории:")
-        print('     {"category.path": {"$regex": "Строительство"}}')
+        print("   • Найти все товары в категории и ее подкатегориях (по индексу):")
+        print('     from category_queries import subtree_filter')
+        print('     offers.find(subtree_filter("_ozon", "Строительство и ремонт"))')
         print("   • Товары конкретного типа:")
         print('     {"offer_type": "Лекарственное средство безрецептурное"}')
         print("   • Поиск по названию:")
@@ -259,5 +318,32 @@ def load_ozon_data():
         import traceback
         traceback.print_exc()
 
+def create_offer_indexes(db):
+    """Создание индексов коллекции offers"""
+    for idx_info in OFFER_INDEXES:
+        field = idx_info["field"]
+        unique = idx_info.get("unique", False)
+        
+        if idx_info.get("type") == "text":
+            # Индекс baseline создан с english: пересоздаем с нужным языком
+            drop_text_index_with_other_language(db.offers, idx_info.get("language", "english"))
+            db.offers.create_index([(field, "text")], default_language=idx_info.get("language", "english"))
+            print(f"  ✓ Текстовый индекс создан: {field}")
+        else:
+            db.offers.create_index([(field, 1)], unique=unique)
+            print(f"  ✓ Индекс создан: {field}" + (" (уникальный)" if unique else ""))
+
 if __name__ == "__main__":
-    load_ozon_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Загрузка данных Ozon в MongoDB")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="Число потоков записи")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="Максимум батчей в очереди записи (по умолчанию 2 x workers)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Продолжить прерванную загрузку с контрольной точки")
+    parser.add_argument("--delta", action="store_true",
+                        help="Синхронизировать коллекцию со снапшотом: писать только изменения")
+    args = parser.parse_args()
+    
+    load_ozon_data(workers=args.workers, queue_size=args.queue_size, resume=args.resume,
+                   delta=args.delta)
\ No newline at end of file
@@ -0,0 +1,41 @@
+import pyarrow.parquet as pq
+
+# Размер батча по умолчанию совпадает с размером пачки вставки в загрузчиках
+DEFAULT_BATCH_SIZE = 10000
+
+
+def open_snapshot(parquet_file):
+    """Открытие Parquet снапшота без чтения данных (только метаданные)"""
+    return pq.ParquetFile(parquet_file)
+
+
+def snapshot_info(parquet_file):
+    """Краткая информация о снапшоте по метаданным файла"""
+    pf = open_snapshot(parquet_file)
+    return {
+        "rows": pf.metadata.num_rows,
+        "row_groups": pf.metadata.num_row_groups,
+        "columns": pf.schema_arrow.names,
+    }
+
+
+def iter_record_batches(parquet_file, columns=None, batch_size=DEFAULT_BATCH_SIZE,
+                        row_groups=None):
+    """
+    Потоковое чтение снапшота по группам строк (row group).
+
+    В памяти одновременно находится только одна группа строк, поэтому
+    пиковое потребление памяти не зависит от размера файла. Возвращает
+    пары (номер row group, pyarrow.RecordBatch не длиннее batch_size).
+    row_groups - номера групп для чтения (по умолчанию все по порядку).
+    """
+    pf = open_snapshot(parquet_file)
+    if row_groups is None:
+        row_groups = range(pf.metadata.num_row_groups)
+
+    for rg_index in row_groups:
+        table = pf.read_row_group(rg_index, columns=columns)
+        for batch in table.to_batches(max_chunksize=batch_size):
+            if batch.num_rows:
+                yield rg_index, batch
+        del table
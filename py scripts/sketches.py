@@ -0,0 +1,317 @@
+from base64 import b64decode, b64encode
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+import hashlib
+import heapq
+import json
+import math
+
+# Файл скетчей products рядом с отчетами загрузки
+SKETCHES_FILE = "products_sketches.json"
+
+
+def hash64(value):
+    """Стабильный между процессами 64-битный хэш значения (hash() строк рандомизирован)"""
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class HyperLogLog:
+    """
+    Оценка числа различных значений: 2^precision однобайтовых регистров.
+
+    Относительная ошибка ~1.04 / sqrt(2^precision) (0,8% при precision=14,
+    16 КБ). Объединение двух скетчей - поэлементный максимум регистров,
+    повторное добавление значения оценку не меняет.
+    """
+
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+
+    def add_many(self, values):
+        registers = self.registers
+        shift = 64 - self.precision
+        mask = (1 << shift) - 1
+        for value in values:
+            h = hash64(value)
+            index = h >> shift
+            rank = shift - (h & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Малые мощности: линейный подсчет по пустым регистрам
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("HyperLogLog с разной точностью нельзя объединить")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def to_dict(self):
+        return {"precision": self.precision, "registers": b64encode(bytes(self.registers)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["precision"], b64decode(data["registers"]))
+
+
+class CountMinSketch:
+    """
+    Частоты значений: depth строк по width счетчиков.
+
+    Оценка никогда не меньше истинной и с вероятностью 1 - e^-depth
+    завышена не больше чем на e / width от общего числа добавлений.
+    Объединение - поэлементная сумма таблиц одного размера.
+    """
+
+    def __init__(self, width=8192, depth=4, table=None):
+        self.width = width
+        self.depth = depth
+        self.table = table if table is not None else [[0] * width for _ in range(depth)]
+
+    def _indexes(self, value):
+        # Двойное хэширование: depth индексов из одного 64-битного хэша
+        h = hash64(value)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, value, count=1):
+        for row, index in zip(self.table, self._indexes(value)):
+            row[index] += count
+
+    def estimate(self, value):
+        return min(row[index] for row, index in zip(self.table, self._indexes(value)))
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Count-Min скетчи разного размера нельзя объединить")
+        self.table = [list(map(sum, zip(mine, theirs))) for mine, theirs in zip(self.table, other.table)]
+
+    def to_dict(self):
+        return {"width": self.width, "depth": self.depth, "table": self.table}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["width"], data["depth"], data["table"])
+
+
+class SpaceSaving:
+    """
+    Частые значения (heavy hitters): не больше capacity счетчиков.
+
+    Новое значение при заполненной таблице вытесняет минимальный счетчик
+    и наследует его как ошибку: count - error - нижняя граница истинной
+    частоты, count - верхняя. Любое значение с частотой больше
+    N / capacity гарантированно остается в таблице.
+    """
+
+    def __init__(self, capacity=256, counters=None):
+        self.capacity = capacity
+        self.counters = counters if counters is not None else {}  # значение -> [count, error]
+        self._heap = None
+
+    def _minimum(self):
+        # Куча с ленивым удалением: устаревшие записи отбрасываются при извлечении
+        if self._heap is None or len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, value) for value, (count, _) in self.counters.items()]
+            heapq.heapify(self._heap)
+        while True:
+            count, value = self._heap[0]
+            counter = self.counters.get(value)
+            if counter is not None and counter[0] == count:
+                return value
+            heapq.heappop(self._heap)
+
+    def add(self, value, count=1):
+        counter = self.counters.get(value)
+        if counter is None and len(self.counters) >= self.capacity:
+            evicted = self._minimum()
+            floor = self.counters.pop(evicted)[0]
+            counter = self.counters[value] = [floor, floor]
+        elif counter is None:
+            counter = self.counters[value] = [0, 0]
+        counter[0] += count
+        if self._heap is not None:
+            heapq.heappush(self._heap, (counter[0], value))
+
+    def top(self, limit):
+        """[(значение, count, error)] по убыванию count"""
+        ranked = sorted(self.counters.items(), key=lambda item: (-item[1][0], str(item[0])))
+        return [(value, count, error) for value, (count, error) in ranked[:limit]]
+
+    def merge(self, other):
+        """Сумма счетчиков обеих таблиц, остаются capacity наибольших"""
+        merged = {}
+        for counters in (self.counters, other.counters):
+            for value, (count, error) in counters.items():
+                counter = merged.setdefault(value, [0, 0])
+                counter[0] += count
+                counter[1] += error
+        ranked = sorted(merged.items(), key=lambda item: -item[1][0])
+        self.counters = dict(ranked[:self.capacity])
+        self._heap = None
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "counters": [[value, count, error] for value, (count, error)
+                                                         in self.counters.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["capacity"], {value: [count, error] for value, count, error in data["counters"]})
+
+
+class ProductSketches:
+    """
+    Скетчи коллекции products, обновляемые загрузчиком по батчам.
+
+    Различные type, category.id и offer_id - HyperLogLog; частые типы и
+    категории - Space-Saving (кандидаты) с оценкой частоты по Count-Min.
+    Партнеров и уровней категорий единицы, для них хранится точный
+    Counter. Все части объединяемы, поэтому скетчи отдельных загрузок
+    или воркеров складываются через merge().
+    """
+
+    HEAVY_DIMENSIONS = ("type", "category")
+
+    def __init__(self):
+        self.generated_at = None
+        self.total = 0
+        self.distinct = {"type": HyperLogLog(), "category": HyperLogLog(), "offer_id": HyperLogLog()}
+        self.frequencies = {dimension: CountMinSketch() for dimension in self.HEAVY_DIMENSIONS}
+        self.heavy_hitters = {dimension: SpaceSaving() for dimension in self.HEAVY_DIMENSIONS}
+        self.partners = Counter()
+        self.depths = Counter()
+
+    @staticmethod
+    def summarize(documents):
+        """
+        Сводка батча для add_summary(): счетчики значений и HyperLogLog offer_id.
+
+        Не зависит от состояния скетчей, поэтому может считаться в воркере
+        EncoderStage по документам до кодирования в BSON.
+        """
+        summary = {"types": Counter(), "categories": Counter(), "partners": Counter(),
+                   "depths": Counter(), "offer_ids": HyperLogLog(), "total": 0}
+        offer_ids = []
+        for doc in documents:
+            category = doc["category"]
+            summary["types"][doc["type"]] += 1
+            summary["categories"][category["id"]] += 1
+            summary["partners"][doc["partner"]] += 1
+            summary["depths"][len(category["breadcrumbs"])] += 1
+            offer_ids.append(doc["offer_id"])
+        summary["offer_ids"].add_many(offer_ids)
+        summary["total"] = len(offer_ids)
+        return summary
+
+    def add(self, documents):
+        """Учесть батч документов products (dict или RawBSONDocument)"""
+        self.add_summary(self.summarize(documents))
+
+    def add_summary(self, summary):
+        """Учесть сводку батча из summarize()"""
+        self.total += summary["total"]
+        self.partners.update(summary["partners"])
+        self.depths.update(summary["depths"])
+        self.distinct["offer_id"].merge(summary["offer_ids"])
+
+        # Внутри батча значения уже сгруппированы: одно обновление на значение
+        for dimension, counter in (("type", summary["types"]), ("category", summary["categories"])):
+            self.distinct[dimension].add_many(counter)
+            for value, count in counter.most_common():
+                self.frequencies[dimension].add(value, count)
+                self.heavy_hitters[dimension].add(value, count)
+
+    def merge(self, other):
+        self.total += other.total
+        for dimension, sketch in self.distinct.items():
+            sketch.merge(other.distinct[dimension])
+        for dimension in self.HEAVY_DIMENSIONS:
+            self.frequencies[dimension].merge(other.frequencies[dimension])
+            self.heavy_hitters[dimension].merge(other.heavy_hitters[dimension])
+        self.partners.update(other.partners)
+        self.depths.update(other.depths)
+
+    # Ответы
+
+    def top(self, dimension, limit):
+        """
+        Частые значения в виде результатов $group: [{_id, count}].
+
+        count - меньшая из двух верхних оценок (Space-Saving и Count-Min).
+        """
+        frequencies = self.frequencies[dimension]
+        candidates = [
+            {"_id": value, "count": min(count, frequencies.estimate(value))}
+            for value, count, _ in self.heavy_hitters[dimension].top(self.heavy_hitters[dimension].capacity)
+        ]
+        candidates.sort(key=lambda stat: (-stat["count"], str(stat["_id"])))
+        return candidates[:limit]
+
+    def statistics(self, top_types=5):
+        """Статистика в форме stats_engine (total, top_types, partners, ...)"""
+        depths = [{"_id": depth, "count": count} for depth, count in sorted(self.depths.items())]
+        return {
+            "total": self.total,
+            "top_types": self.top("type", top_types),
+            "partners": [{"_id": partner, "count": count} for partner, count in self.partners.most_common()],
+            "unique_types": self.distinct["type"].count(),
+            "unique_categories": self.distinct["category"].count(),
+            "unique_offer_ids": self.distinct["offer_id"].count(),
+            "depths": depths,
+            "avg_level": (sum(stat["_id"] * stat["count"] for stat in depths) / self.total
+                          if self.total else None),
+        }
+
+    # Хранение
+
+    def to_dict(self):
+        return {
+            "generated_at": self.generated_at,
+            "total": self.total,
+            "distinct": {dimension: sketch.to_dict() for dimension, sketch in self.distinct.items()},
+            "frequencies": {dimension: sketch.to_dict() for dimension, sketch in self.frequencies.items()},
+            "heavy_hitters": {dimension: sketch.to_dict() for dimension, sketch in self.heavy_hitters.items()},
+            # Ключи JSON - строки, поэтому пары списком
+            "partners": list(self.partners.items()),
+            "depths": list(self.depths.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketches = cls()
+        sketches.generated_at = data["generated_at"]
+        sketches.total = data["total"]
+        sketches.distinct = {dimension: HyperLogLog.from_dict(sketch)
+                             for dimension, sketch in data["distinct"].items()}
+        sketches.frequencies = {dimension: CountMinSketch.from_dict(sketch)
+                                for dimension, sketch in data["frequencies"].items()}
+        sketches.heavy_hitters = {dimension: SpaceSaving.from_dict(sketch)
+                                  for dimension, sketch in data["heavy_hitters"].items()}
+        sketches.partners = Counter(dict(data["partners"]))
+        sketches.depths = Counter(dict(data["depths"]))
+        return sketches
+
+    def save(self, path):
+        self.generated_at = datetime.utcnow().isoformat()
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+
+from bulk_writer import BulkWriter
+
+# Число потоков записи по умолчанию
+DEFAULT_WORKERS = 4
+
+
+class WorkerStats:
+    """Счетчики одного потока записи"""
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.batches = 0
+        self.documents = 0
+        self.busy_seconds = 0.0
+        self.errors = 0
+
+    @property
+    def docs_per_second(self):
+        return self.documents / self.busy_seconds if self.busy_seconds > 0 else 0
+
+
+class WriterPool:
+    """
+    Конвейерная запись: ограниченная очередь батчей и N потоков записи.
+
+    Поток, который строит документы, только кладет батчи в очередь;
+    сетевой обмен и вставка на сервере идут параллельно в потоках пула.
+    Когда очередь заполнена, submit() блокируется (backpressure), поэтому
+    в памяти не больше queue_size + workers батчей. По умолчанию батч
+    пишется через BulkWriter.insert (повторы временных ошибок).
+    """
+
+    def __init__(self, collection, workers=DEFAULT_WORKERS, queue_size=None, write=None):
+        self.collection = collection
+        self.write = write or BulkWriter(collection).insert
+        self.queue = queue.Queue(maxsize=queue_size or workers * 2)
+        self.stats = [WorkerStats(i) for i in range(workers)]
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+
+        self.threads = []
+        for stats in self.stats:
+            thread = threading.Thread(target=self._run, args=(stats,),
+                                      name=f"writer-{stats.worker_id}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, documents, on_done=None):
+        """Поставить батч в очередь записи; on_done(inserted) вызывается из потока пула"""
+        self._put((documents, on_done))
+
+    def _put(self, item):
+        # Без живых потоков очередь не разберется: ошибка вместо вечного ожидания
+        while True:
+            if not any(thread.is_alive() for thread in self.threads):
+                raise RuntimeError(f"Все потоки записи в {self.collection.full_name} остановились")
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self, stats):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+
+                documents, on_done = item
+                start = time.perf_counter()
+                try:
+                    inserted = self.write(documents)
+                except Exception as e:
+                    stats.errors += 1
+                    print(f"  ✗ Ошибка записи в потоке {stats.worker_id}: {e}")
+                    continue
+                finally:
+                    stats.busy_seconds += time.perf_counter() - start
+
+                stats.batches += 1
+                stats.documents += inserted
+                if on_done is not None:
+                    try:
+                        on_done(inserted)
+                    except Exception as e:
+                        stats.errors += 1
+                        print(f"  ✗ Ошибка обработки записанного батча в потоке {stats.worker_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """Дождаться записи всех батчей и остановить потоки"""
+        for _ in self.threads:
+            self._put(None)
+        for thread in self.threads:
+            thread.join()
+        self.finished_at = time.perf_counter()
+        return self.stats
+
+    @property
+    def total_documents(self):
+        return sum(stats.documents for stats in self.stats)
+
+    def print_report(self):
+        """Пропускная способность по каждому потоку и в целом"""
+        elapsed = (self.finished_at or time.perf_counter()) - self.started_at
+
+        print(f"\n  ПРОПУСКНАЯ СПОСОБНОСТЬ ЗАПИСИ (потоков: {len(self.stats)}):")
+        for stats in self.stats:
+            print(f"    Поток {stats.worker_id}: батчей {stats.batches:,}, документов {stats.documents:,}, "
+                  f"занят {stats.busy_seconds:.1f} с, {stats.docs_per_second:,.0f} док/сек"
+                  + (f", ошибок {stats.errors}" if stats.errors else ""))
+
+        total = self.total_documents
+        speed = total / elapsed if elapsed > 0 else 0
+        print(f"    Итого: {total:,} документов за {elapsed:.1f} с ({speed:,.0f} док/сек)")